@@ -34,6 +34,20 @@ CREATE TABLE friends (
   INDEX (friend_id)
 );
 
+-- Users whose friends did not change since the last crawl, see loader.py
+CREATE TABLE friends_touch (
+	user_id BIGINT UNSIGNED PRIMARY KEY,
+	date_last TIMESTAMP DEFAULT 0
+);
+
+-- Friends a user stopped following, see process_friends_delta
+CREATE TABLE unfollows (
+	user_id BIGINT UNSIGNED,
+	friend_id BIGINT UNSIGNED,
+	date_removed TIMESTAMP DEFAULT 0,
+	UNIQUE (user_id, friend_id, date_removed)
+);
+
 CREATE TABLE mentions (
 	tweet_id BIGINT UNSIGNED,
 	user_id BIGINT UNSIGNED,
@@ -61,6 +75,21 @@ CREATE TABLE users_update (
   INDEX (user_id)
 );
 
+-- Users not crawled yet and the friends rows pointing at them, kept by
+-- the loader for the generator, see seed_frontier
+CREATE TABLE frontier (
+	user_id BIGINT UNSIGNED PRIMARY KEY,
+	in_degree INT UNSIGNED DEFAULT 0,
+  INDEX (in_degree)
+);
+
+-- Seed files claimed by crawler nodes, see leases.py
+CREATE TABLE seed_leases (
+	seed VARCHAR(255) PRIMARY KEY,
+	node VARCHAR(100),
+	expires TIMESTAMP DEFAULT 0
+);
+
 -- Snorg Account creation
 -- CREATE USER 'snorgadmin'@'localhost' IDENTIFIED BY 'snorg321';
 -- GRANT ALL PRIVILEGES ON twaler.* TO 'snorgadmin'@'localhost';
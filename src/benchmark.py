@@ -0,0 +1,228 @@
+#!/usr/bin/python2.6
+import os
+import sys
+import gzip
+import json
+import time
+import shutil
+import logging
+import tempfile
+
+import misc
+import loader
+import crawler
+import mockapi
+import processor
+
+
+def cache_size(cache_dir):
+    """Return (files, bytes) under cache_dir"""
+    files = size = 0
+    for (dirpath, dirnames, filenames) in os.walk(cache_dir):
+        for filename in filenames:
+            files += 1
+            size += os.path.getsize(os.path.join(dirpath, filename))
+    return (files, size)
+
+
+def check_records(cache_dir, logger):
+    """Return (records listed, records stored) of a crawled cache, the
+    lines of its manifests or segment indexes against the records they
+    name that can be read back"""
+    listed = 0
+    for kind in (misc.CacheAccessor.MANIFEST_DIR,
+                 misc.SegmentCacheAccessor.SEGMENT_DIR):
+        dir_kind = os.path.join(cache_dir, kind)
+        if not os.path.isdir(dir_kind):
+            continue
+        for name in os.listdir(dir_kind):
+            if name.endswith('.txt') or name.endswith('.idx'):
+                fp = open(os.path.join(dir_kind, name))
+                listed += sum([1 for line in fp])
+                fp.close()
+    accessor = misc.get_cache_accessor(cache_dir, logger)
+    stored = 0
+    for (uid, path) in accessor.idqueue():
+        for filename in set(accessor.get_infiles(path)):
+            if (isinstance(accessor, misc.SegmentCacheAccessor) or
+                    os.path.exists(os.path.join(path, filename))):
+                stored += 1
+    accessor.close()
+    return (listed, stored)
+
+
+def process(config, logger, cache_dir):
+    """Process a crawled cache, return a report line"""
+    instance = misc.timefunctions.datestamp()
+    start = time.time()
+    processor.Processor(config, logger).process(instance, cache_dir)
+    elapsed = time.time() - start
+    dir_processed = os.path.join(cache_dir, 'processed_crawl')
+    rows = 0
+    for table in os.listdir(dir_processed):
+        if table.endswith('.gz'):
+            fp = gzip.open(os.path.join(dir_processed, table))
+        else:
+            fp = open(os.path.join(dir_processed, table))
+        rows += sum([1 for line in fp])
+        fp.close()
+    users = len([user for user in
+                 misc.get_cache_accessor(cache_dir, logger).idqueue()])
+    return ('%-12s %7.1f s %7d users %8.1f users/s %9d rows %9.1f rows/s' %
+            ('process', elapsed, users, users / elapsed, rows,
+             rows / elapsed))
+
+
+def load(config, logger, rows, workdir):
+    """Load made up tweets, mentions and friends tables of rows rows each
+    into empty tables, return a report line"""
+    dir_data = os.path.join(workdir, 'load_%d' % rows)
+    os.makedirs(dir_data)
+    tables = {'tweets': '%d\t%d\t%d\t2012-03-10 10:10:10\ttweet %d\n',
+              'mentions': '%d\t%d\n',
+              'friends': '%d\t%d\t2012-03-10 10:10:10\t'
+                         '2012-03-10 10:10:10\n'}
+    for table in tables:
+        fp = open(os.path.join(dir_data, table + '.tsv'), 'wb', 1024 * 1024)
+        for i in xrange(rows):
+            values = (i, i % 1000 + 1, i % 5, i)
+            fp.write(tables[table] % values[:tables[table].count('%')])
+        fp.close()
+    bulk = loader.create(config, logger)
+    for table in tables:
+        bulk.execute('DELETE FROM ' + table)
+    start = time.time()
+    ok = bulk.load(dir_data)
+    elapsed = time.time() - start
+    shutil.rmtree(dir_data, True)
+    backend = config.get('db_backend', 'mysql')
+    if backend == 'mysql':
+        backend = config.get('loader_backend', 'cli')
+    return ('%-12s %7.1f s %9d rows %9.1f rows/s  %d workers, chunks of '
+            '%s rows, indexes %s%s' % ('load ' + backend, elapsed,
+            rows * len(tables), rows * len(tables) / elapsed, bulk.workers,
+            bulk.chunk_rows or 'all', bulk.defer or 'kept',
+            '' if ok else '  FAILED'))
+
+
+def run(config, logger, engine, seed_file, workdir, also_process=False):
+    """Crawl seed_file with one engine setting, return a report line.
+    engine is threads:N or async:N"""
+    (name, width) = (engine.split(':') + [''])[:2]
+    config = dict(config)
+    config['crawl_engine'] = name
+    if width:
+        if name == 'async':
+            config['crawl_async_concurrency'] = int(width)
+        else:
+            config['crawl_num_of_threads'] = int(width)
+    cache_dir = os.path.join(workdir, 'cache_' + engine.replace(':', '_'))
+    config['dir_watermarks'] = cache_dir + '_watermarks'
+    crawl = crawler.Crawler(config, logger)
+    start = time.time()
+    crawl.crawl(seed_file, cache_dir)
+    elapsed = time.time() - start
+    crawl.pool.close()
+    (files, size) = cache_size(cache_dir)
+    stats = crawl.stats
+    report = ('%-12s %7.1f s %7d req %8.1f req/s  p50 %6.1f  p90 %6.1f  '
+              'p99 %6.1f ms  %6d files %9.1f KB' % (engine, elapsed,
+              stats.requests, stats.requests / elapsed,
+              stats.percentile(0.5) * 1000, stats.percentile(0.9) * 1000,
+              stats.percentile(0.99) * 1000, files, size / 1024.0))
+    (listed, stored) = check_records(cache_dir, logger)
+    report += '\n%-12s %7d records listed %7d stored' % ('records', listed,
+                                                          stored)
+    if listed != stored:
+        report += '  LOST %d' % (listed - stored)
+    if also_process:
+        report += '\n' + process(config, logger, cache_dir)
+    return (report, listed - stored)
+
+
+def main():
+    parser = mockapi.options()
+    parser.usage = ('%prog [options]\n\nCrawl made up users from a local '
+                    'mock API with every --engine and compare')
+    parser.add_option('--engine', action='append', default=[],
+                      help='threads:N or async:N, may be repeated')
+    parser.add_option('--users', type='int', default=200,
+                      help='number of seeds to crawl')
+    parser.add_option('--keep', action='store_true',
+                      help='keep the crawled caches')
+    parser.add_option('--process', action='store_true',
+                      help='also time processing every crawled cache')
+    parser.add_option('--process-only', metavar='CACHE_DIR',
+                      help='only time processing an existing cache')
+    parser.add_option('--load', metavar='ROWS,ROWS,...',
+                      help='only time loading made up tables of so many '
+                           'rows each, emptying them first')
+    parser.add_option('--load-database', metavar='DATABASE',
+                      help='scratch database for --load, never db_database, '
+                           'a file with --db-backend sqlite')
+    parser.add_option('--db-backend', choices=('mysql', 'sqlite'),
+                      help='db_backend of config.json for --load')
+    parser.set_defaults(port=0)     # any free port
+    (opts, args) = parser.parse_args()
+    engines = opts.engine or ['threads:2', 'threads:8', 'async:100']
+
+    # Load global configurations
+    fp = open('config.json')
+    config = json.load(fp)
+    fp.close()
+
+    # Only complain about trouble, the report is the output
+    logging.basicConfig(level=logging.WARNING)
+    logger = logging.getLogger('')
+
+    if opts.load:
+        if not opts.load_database:
+            parser.error('--load empties tables, name a scratch database '
+                         'with --load-database')
+        if opts.db_backend:
+            config['db_backend'] = opts.db_backend
+        config['db_database'] = config['db_sqlite'] = opts.load_database
+        workdir = tempfile.mkdtemp(prefix='twaler_benchmark_')
+        for rows in opts.load.split(','):
+            print(load(config, logger, int(rows), workdir))
+        shutil.rmtree(workdir, True)
+        return
+
+    if opts.process_only:
+        # the watermarks crawling the cache left, as run sets them
+        config['dir_watermarks'] = opts.process_only.rstrip('/') + \
+                '_watermarks'
+        print(process(config, logger, opts.process_only))
+        return
+
+    server = mockapi.create(opts)
+    config['crawl_api_base'] = server.start()
+    config['crawl_status_url'] = server.status_url()
+
+    workdir = tempfile.mkdtemp(prefix='twaler_benchmark_')
+    seed_file = os.path.join(workdir, 'seeds.txt')
+    fp = open(seed_file, 'w')
+    for i in xrange(opts.users):
+        fp.write('utf\t%d\n' % (100000 + i * 7))
+    fp.close()
+
+    print('%d users, latency %s s, error rate %s, gzip %s' %
+          (opts.users, opts.latency, opts.error_rate, opts.gzip))
+    lost = 0
+    for engine in engines:
+        (report, missing) = run(config, logger, engine, seed_file, workdir,
+                                opts.process)
+        print(report)
+        lost += missing
+    print(server.report())
+    server.shutdown()
+    if opts.keep:
+        print('caches kept in ' + workdir)
+    else:
+        shutil.rmtree(workdir, True)
+    if lost:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,21 @@
 #!/usr/bin/python2.6
 from __future__ import with_statement
 import os
+import sys
 import time
-import urllib2
+import heapq
+import random
+import select
+import socket
+import asyncore
+import urllib
+import httplib
+import urlparse
+import mimetools
+import StringIO
 import threading
 import Queue
+import gzip
 import json
 import logging
 import traceback
@@ -19,132 +30,527 @@ class Crawler:
     def __init__(self, config, logger):
         self.config = config
         self.logger = logger
-        self.idqueue = Queue.Queue(0)
+        # bounded, the seed reader waits for the workers to catch up
+        self.idqueue = Queue.Queue(self.config.get('crawl_queue_size', 1000))
+        # keep-alive connections are shared by all workers
+        self.pool = ConnectionPool(self.config, self.logger)
+        # one limiter for the whole process, quota is per account not thread
+        self.ratelimiter = RateLimiter(self.config, self.logger, self.pool)
+        # retry delays and crawler-wide pauses
+        self.backoff = BackoffController(self.config, self.logger,
+                self.ratelimiter)
+        # latency and volume of the requests of the last crawl
+        self.stats = CrawlStats()
 
     def crawl(self, seed_file, cache_dir):
-        seed_file = seed_file
         if not os.path.exists(cache_dir):
             os.makedirs(cache_dir)
+        seeds = self.seeds(seed_file)
+        if self.config.get('crawl_priority_window', 0) > 1:
+            seeds = self.prioritize(seeds)
+        seeds = self.batch(seeds)
+        self.stats.reset()
+        try:
+            if self.config.get('crawl_engine', 'threads') == 'async':
+                self.crawl_async(seeds, cache_dir)
+            else:
+                self.crawl_threads(seeds, cache_dir)
+            self.logger.info("Crawling file %s COMPLETE" % seed_file)
+        except Exception as e:
+            traceback.print_stack()
+            self.logger.error(str(e))
+        self.logger.info(self.stats.report())
+        self.pool.report()
+        self.logger.debug("crawl loop exit successfully")
+
+    def seeds(self, seed_file):
+        """Yield the seed lines of seed_file, one at a time"""
+        seedFileStream = open(os.path.join(seed_file),"r")
+        self.logger.info("Crawling " + seed_file)
+        try:
+            while True:
+                line = seedFileStream.readline()
+                if not line:
+                    break
+                seed = line.strip()
+                if not seed or seed[0] == "#":  # skip blanks and comments
+                    continue
+                yield seed
+        finally:
+            seedFileStream.close()
+
+    def prioritize(self, seeds):
+        """Reorder seeds so that out of every crawl_priority_window of them
+        the highest priority ones come first, in fixed memory"""
+        window = self.config['crawl_priority_window']
+        heap = []
+        sequence = 0    # keeps file order between equal priorities
+        for seed in seeds:
+            sequence += 1
+            item = (-_SeedFetcher.priority(seed), sequence, seed)
+            if len(heap) < window:
+                heapq.heappush(heap, item)
+            else:
+                yield heapq.heappushpop(heap, item)[2]
+        while heap:
+            yield heapq.heappop(heap)[2]
+
+    def batch(self, seeds):
+        """Pull the userinfo work out of seeds into lookups of up to
+        crawl_lookup_batch users, the rest of every seed passes through"""
+        size = self.config.get('crawl_lookup_batch', 100)
+        pending = []
+        for seed in seeds:
+            (types, uids) = _SeedFetcher.parse(seed)
+            if size <= 1 or _SeedFetcher.CRAWL_USERINFO not in types:
+                yield seed
+                continue
+            types = types.replace(_SeedFetcher.CRAWL_USERINFO, '')
+            if types:
+                yield "%s\t%s" % (types, ",".join(uids))
+            pending.extend(uids)
+            while len(pending) >= size:
+                yield "%s\t%s" % (_SeedFetcher.CRAWL_USERINFO,
+                                   ",".join(pending[:size]))
+                pending = pending[size:]
+        if pending:
+            yield "%s\t%s" % (_SeedFetcher.CRAWL_USERINFO, ",".join(pending))
+
+    def crawl_threads(self, seeds, cache_dir):
+        """Crawl with crawl_num_of_threads blocking worker threads"""
         workers = []       # set up workers
         for i in range(self.config['crawl_num_of_threads']):
             worker = _CrawlerWorker(self.idqueue, self.config,
-                    self.logger, cache_dir)
+                    self.logger, cache_dir, self.ratelimiter, self.pool,
+                    self.backoff, self.stats)
             worker.setName("Worker " + str(i))
             workers.append(worker)
             worker.start()
         try:
             # read seed file and crawl
-            seedFileStream = open(os.path.join(seed_file),"r")
-            self.logger.info("Crawling " + seed_file)
-            while True:
-                line = seedFileStream.readline()
-                if not line:
-                    break
-                seed = line.strip()
-                if seed[0] == "#":      # check for comments
-                    break
+            for seed in seeds:
                 self.idqueue.put(seed)  # put seeds on queue
             self.idqueue.join()         # block until all seeds are processed
-            self.logger.info("Crawling file %s COMPLETE" % seed_file)
-            seedFileStream.close()
-        except Exception as e:
-            traceback.print_stack()
-            self.logger.error(str(e))
-        for th in workers:         # send terminating signals to workers
-            self.idqueue.put(_CrawlerWorker.TERMINATE_SIGNAL)
-        for th in workers:         # wait for all workers to return
-            th.join()
-        self.logger.debug("crawl loop exit successfully")
+        finally:
+            for th in workers:     # send terminating signals to workers
+                self.idqueue.put(_CrawlerWorker.TERMINATE_SIGNAL)
+            for th in workers:     # wait for all workers to return
+                th.join()
 
+    def crawl_async(self, seeds, cache_dir):
+        """Crawl with a single thread multiplexing up to
+        crawl_async_concurrency seeds over non-blocking sockets"""
+        engine = _AsyncEngine(self.config, self.logger, cache_dir,
+                self.ratelimiter, self.backoff, self.stats)
+        engine.run(seeds)
 
-class _CrawlerWorker(threading.Thread):
-    """ _CrawlerWorker represents a worker that crawl and save info"""
-    CRAWL_USERINFO = 'u'
-    CRAWL_TWEETS = 't'
-    CRAWL_FRIENDS = 'f'
-    TERMINATE_SIGNAL = 'TERMINATE'
 
-    def __init__(self, idqueue, config, logger, cachedir):
-        threading.Thread.__init__(self)
+class CrawlStats:
+    """Request count, bytes and latency samples of a crawl, the latencies
+    are a fixed size uniform sample however long the crawl"""
+    SAMPLES = 10000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.started = time.time()
+        self.requests = 0
+        self.bytes = 0
+        self.latencies = []
+
+    def record(self, latency, nbytes):
+        with self.lock:
+            self.requests += 1
+            self.bytes += nbytes
+            if len(self.latencies) < CrawlStats.SAMPLES:
+                self.latencies.append(latency)
+            else:
+                # reservoir sampling
+                i = random.randint(0, self.requests - 1)
+                if i < CrawlStats.SAMPLES:
+                    self.latencies[i] = latency
+
+    def percentile(self, p):
+        with self.lock:
+            latencies = sorted(self.latencies)
+        if not latencies:
+            return 0
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+
+    def rate(self):
+        return self.requests / max(time.time() - self.started, 1e-6)
+
+    def report(self):
+        return ("API requests: %d, %.1f req/s, %.1f KB received, latency "
+                "p50 %.1f ms p90 %.1f ms p99 %.1f ms" % (self.requests,
+                self.rate(), self.bytes / 1024.0,
+                self.percentile(0.5) * 1000, self.percentile(0.9) * 1000,
+                self.percentile(0.99) * 1000))
+
+
+class ConnectionPool:
+    """Keep-alive HTTP connections, a few idle ones kept per API host
+
+    Connections are checked out for one request at a time, so the pool can
+    be shared by every worker thread.  Idle connections older than
+    crawl_pool_idle_timeout are closed instead of reused, since the server
+    has most likely dropped them already.
+    """
+    def __init__(self, config, logger):
         self.config = config
         self.logger = logger
-        self.cache_accessor = misc.CacheAccessor(cachedir, self.logger)
-        self.idqueue = idqueue
+        self.size = self.config.get('crawl_pool_size', 4)
+        self.idle_timeout = self.config.get('crawl_pool_idle_timeout', 30)
+        self.lock = threading.Lock()
+        self.idle = {}          # host -> list of (last_used, connection)
+        self.reset_stats()
 
-    def gethttpresponse(self, url, datagzipped=False):
-        """Get http response for url, ignore the header and return a
-        pair consists of the content and whether the content is gzipped"""
-        response = None
-        request = urllib2.Request(url)
-        if datagzipped:
-            request.add_header('Accept-encoding', 'gzip')
-        for attempt in xrange(9):
+    def reset_stats(self):
+        self.requests = 0
+        self.reused = 0
+        self.opened = 0
+        self.connect_time = 0.0
+
+    def checkout(self, host):
+        """Return (connection, reused) for host"""
+        with self.lock:
+            self.requests += 1
+            idle = self.idle.get(host, [])
+            now = time.time()
+            while idle:
+                (last_used, conn) = idle.pop()
+                if now - last_used < self.idle_timeout:
+                    self.reused += 1
+                    return (conn, True)
+                conn.close()
+        conn = httplib.HTTPConnection(host)
+        start = time.time()
+        conn.connect()
+        with self.lock:
+            self.opened += 1
+            self.connect_time += time.time() - start
+        return (conn, False)
+
+    def checkin(self, host, conn):
+        with self.lock:
+            idle = self.idle.setdefault(host, [])
+            if len(idle) < self.size:
+                idle.append((time.time(), conn))
+                return
+        conn.close()
+
+    def request(self, url, headers={}):
+        """GET url, return (status, headers, body)
+        raises httplib.HTTPException or socket.error on failure"""
+        (scheme, host, path, query, fragment) = urlparse.urlsplit(url)
+        if query:
+            path += '?' + query
+        while True:
+            (conn, reused) = self.checkout(host)
             try:
-                response = urllib2.urlopen(request)
-                headers = response.headers
-                if response.code == 200:
-                    gzipped = headers.getheader('content-encoding')
-                    return (response.read(), gzipped)
-                else:
-                    self.logger.debug('HTTP code %s on attempt _%s_ %s' %
-                            (response.code, attempt, url))
-            except urllib2.HTTPError as e:
-                if e.code == 400:
-                    self.logger.info("400, API limit reached, sleep 10 mins")
-                    time.sleep(10 * 60)
-                elif e.code == 401:
-                    # User doesn't allow public access
-                    return (None, None)
-                elif e.code == 404:
-                    # User doesn't exist anymore
-                    return (None, None)
-                else:
-                    self.logger.debug("HTTPError on attempt _%s_ %s %s" %
-                            (attempt, url, e))
-                    time.sleep(self.config['crawl_retry_gap'])
-            except urllib2.URLError as e:
-                self.logger.debug("URLError on attempt _%s_ %s %s: %s" %
-                        (attempt, url, e.reason, e))
-                time.sleep(self.config['crawl_retry_gap'])
-        self.logger.error('HTTP fetching failure for %s' % url)
-        return (None, None)
+                conn.request('GET', path, headers=headers)
+                response = conn.getresponse()
+                body = response.read()
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                if reused:
+                    # the server dropped an idle connection, reconnect
+                    continue
+                raise
+            if response.will_close:
+                conn.close()
+            else:
+                self.checkin(host, conn)
+            return (response.status, response.msg, body)
+
+    def close(self):
+        """Close every idle connection"""
+        with self.lock:
+            for idle in self.idle.values():
+                for (last_used, conn) in idle:
+                    conn.close()
+            self.idle = {}
+
+    def report(self):
+        """Log how often connections were reused since the last report"""
+        with self.lock:
+            if self.requests:
+                handshake = self.connect_time / max(self.opened, 1)
+                self.logger.info("HTTP connections: %d requests, %d reused "
+                        "(%.1f%%), %d opened, %.1f ms per connect, about "
+                        "%.1f s of handshakes saved" % (self.requests,
+                        self.reused, 100.0 * self.reused / self.requests,
+                        self.opened, handshake * 1000,
+                        handshake * self.reused))
+            self.reset_stats()
+
+
+class RateLimiter:
+    """Token bucket of API requests shared by all crawler workers
+
+    The bucket is refilled from the X-RateLimit headers that come back with
+    every API response.  The rate limit status endpoint is only probed when
+    the state is unknown, i.e. before the first request and after a window
+    reset whose size we never learned.  Workers block in acquire() while the
+    bucket is empty instead of sleeping on their own.
+    """
+    STATUS_URL = "http://twitter.com/account/rate_limit_status.json"
+    MARGIN = 1      # reset times are whole seconds, wait for the next one
+
+    def __init__(self, config, logger, pool):
+        self.config = config
+        self.logger = logger
+        self.pool = pool
+        self.status_url = self.config.get('crawl_status_url',
+                                          RateLimiter.STATUS_URL)
+        self.condition = threading.Condition()
+        self.remaining = None       # None means unknown, probe before use
+        self.limit = None           # size of a full window, once known
+        self.reset_time = 0         # epoch seconds the window resets at
+        self.probing = False
+
+    def acquire(self, blocking=True):
+        """Take one request from the bucket, block until the window resets
+        if it is empty.  Return False instead of blocking if not blocking"""
+        self.condition.acquire()
+        try:
+            while True:
+                now = time.time()
+                if self.remaining is not None and self.remaining <= 0 and \
+                        now >= self.reset_time + RateLimiter.MARGIN:
+                    # window has reset, refill if we know its size
+                    self.remaining = self.limit
+                if self.remaining is None:
+                    if not self.probing:
+                        self.refresh()
+                        continue
+                elif self.remaining > 0:
+                    self.remaining -= 1
+                    return True
+                if not blocking:
+                    return False
+                if self.remaining is not None:
+                    self.logger.info('API limit reached, resume in %d secs' %
+                            max(0, self.reset_time + RateLimiter.MARGIN - now))
+                # wake up periodically in case the clock jumps
+                self.condition.wait(min(max(self.reset_time - now, 1), 60))
+        finally:
+            self.condition.release()
+
+    def delay(self):
+        """Return seconds until a request might be available again"""
+        self.condition.acquire()
+        try:
+            if self.remaining is None or self.remaining > 0:
+                return 0
+            return max(0, self.reset_time + RateLimiter.MARGIN - time.time())
+        finally:
+            self.condition.release()
+
+    def refresh(self):
+        """Probe the status endpoint, called with the condition held"""
+        self.probing = True
+        self.condition.release()
+        try:
+            (remaining, reset_time, limit) = self.probe()
+        finally:
+            self.condition.acquire()
+            self.probing = False
+        self.remaining = remaining
+        self.reset_time = reset_time
+        if limit:
+            self.limit = limit
+        self.condition.notifyAll()
 
-    def getrequestquota(self):
-        """Return the number of requests we have left"""
-        url = "http://twitter.com/account/rate_limit_status.json"
+    def update(self, headers):
+        """Refill the bucket from the rate limit headers of a response"""
+        try:
+            remaining = headers.get('X-RateLimit-Remaining')
+            reset_time = headers.get('X-RateLimit-Reset')
+            limit = headers.get('X-RateLimit-Limit')
+            if remaining is None or reset_time is None:
+                return
+            remaining = int(remaining)
+            reset_time = int(reset_time)
+        except (ValueError, AttributeError):
+            return
+        self.condition.acquire()
+        try:
+            if limit:
+                self.limit = int(limit)
+            if reset_time != self.reset_time or self.remaining is None:
+                # a new window, trust the server
+                self.remaining = remaining
+                self.reset_time = reset_time
+            else:
+                # requests still in flight already took from our count
+                self.remaining = min(self.remaining, remaining)
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+    def exhaust(self, reset_time=None):
+        """Empty the bucket after the API refused a request, by default
+        wait 10 mins if the response did not say when to come back"""
+        if not reset_time:
+            reset_time = time.time() + 10 * 60
+        self.condition.acquire()
+        try:
+            self.remaining = 0
+            self.reset_time = max(self.reset_time, int(reset_time))
+        finally:
+            self.condition.release()
+
+    def probe(self):
+        """Return (remaining, reset_time, limit) from the status endpoint"""
         for attempt in xrange(5):   # make 5 attempts, stop if failed
             # Try and get rate limit
             try:
-                page = urllib2.urlopen(url)
-                if page.code == 200:
-                    info = json.loads(page.read().decode())
-                    return info['remaining_hits']
+                (code, headers, body) = self.pool.request(self.status_url)
+                if code == 200:
+                    info = json.loads(body.decode())
+                    return (info['remaining_hits'],
+                            info['reset_time_in_seconds'],
+                            info.get('hourly_limit'))
                 # Request returned a bad code
                 self.logger.warning("rate limit status request returned: "
-                        "%d %s" % (page.code, page.msg));
+                        "%d" % code);
             # Request caused an exception
-            except urllib2.HTTPError as e:
-                self.logger.debug("HTTPError checking rate limit :%s" % e)
-                        
-            except urllib2.URLError as e:
-                self.logger.debug("URLError checking rate limit %s: %s" %
-                        (e.reason, e))
+            except (httplib.HTTPException, socket.error) as e:
+                self.logger.debug("Error checking rate limit: %s" % e)
             time.sleep(10)
-        # no response for 5 times, return zero
+        # no response for 5 times, assume no quota for 15 mins
         self.logger.warning("rate limit request failed")
-        return 0
+        return (0, time.time() + 15 * 60, None)
+
+
+class BackoffController:
+    """Crawler-wide retry policy
+
+    Failed requests (5xx, connection errors) are retried after an
+    exponentially growing delay with jitter, so workers that failed together
+    do not come back together.  A rate limit response, or a streak of
+    crawl_failure_streak failures in a row across all workers, pauses every
+    worker at once until the reset time has passed.
+    """
+    RATE_LIMITED = (400, 420, 429)
+
+    def __init__(self, config, logger, ratelimiter):
+        self.config = config
+        self.logger = logger
+        self.ratelimiter = ratelimiter
+        self.base = self.config['crawl_retry_gap']
+        self.cap = self.config.get('crawl_backoff_max', 300)
+        self.threshold = self.config.get('crawl_failure_streak', 5)
+        self.condition = threading.Condition()
+        self.resume_time = 0
+        self.streak = 0         # failures in a row, all workers together
+
+    def delay(self, attempt):
+        """Return the jittered delay before retry number attempt"""
+        delay = min(self.cap, self.base * 2 ** attempt)
+        return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+    def wait(self):
+        """Block while the crawler is paused"""
+        self.condition.acquire()
+        try:
+            while True:
+                remaining = self.resume_time - time.time()
+                if remaining <= 0:
+                    return
+                self.condition.wait(min(remaining, 60))
+        finally:
+            self.condition.release()
+
+    def paused_for(self):
+        """Return seconds left in the current pause, 0 if not paused"""
+        return max(0, self.resume_time - time.time())
+
+    def pause(self, until, reason):
+        """Hold every worker until the epoch time until"""
+        self.condition.acquire()
+        try:
+            if until > self.resume_time:
+                self.resume_time = until
+                self.logger.info("%s, pausing all workers for %d secs" %
+                        (reason, until - time.time()))
+        finally:
+            self.condition.release()
+
+    def success(self):
+        self.streak = 0
+
+    def failure(self, attempt):
+        """Record a failed request, return how long its worker waits"""
+        self.condition.acquire()
+        try:
+            self.streak += 1
+            streak = self.streak
+        finally:
+            self.condition.release()
+        if streak >= self.threshold:
+            # the API itself is in trouble, back off everybody
+            self.pause(time.time() + self.delay(streak - self.threshold),
+                       "%d failures in a row" % streak)
+        return self.delay(attempt)
+
+    def rate_limited(self, code, headers):
+        """Pause everybody until the limit resets, 10 mins if the response
+        does not say when that is"""
+        now = time.time()
+        until = now + 10 * 60
+        try:
+            if headers.get('Retry-After'):
+                until = now + int(headers.get('Retry-After'))
+            elif headers.get('X-RateLimit-Reset'):
+                until = int(headers.get('X-RateLimit-Reset'))
+        except ValueError:
+            pass
+        self.ratelimiter.exhaust(until)
+        # never retry right away, the reset may have just passed
+        until = max(until, now) + RateLimiter.MARGIN
+        self.pause(until, "%s, API limit reached" % code)
+
+
+class _SeedFetcher:
+    """Turns seeds into fetch plans, shared by both crawl engines
+
+    A fetch plan is a generator that yields (url, datagzipped) requests and
+    is sent back the (content, gzipped) pair of each response, or
+    (None, None) if the download failed.  The engine driving a plan
+    decides how the requests go over the wire.
+    """
+    CRAWL_USERINFO = 'u'
+    CRAWL_TWEETS = 't'
+    CRAWL_FRIENDS = 'f'
+
+    def __init__(self, config, logger, cachedir):
+        self.config = config
+        self.logger = logger
+        self.cache_accessor = misc.get_cache_accessor(cachedir, self.logger,
+                self.config.get('dir_watermarks'), self.config)
+        self.api = self.config.get('crawl_api_base',
+                                   'http://api.twitter.com/1')
 
     def cache(self, request_type, uid, data, datagzipped=False):
         self.cache_accessor.store_in_cache(request_type, uid, data,
                                            datagzipped)
         return
 
-    def fetch(self, seed):
-        # check rate limit, sleep if no quota
-        while (self.getrequestquota() == 0):
-            self.logger.info('API limit reached, retry after 15 mins')
-            time.sleep(15 * 60)
-        # parse the seed line
+    @staticmethod
+    def decode(page, gzipped):
+        """Return the response content as text"""
+        if gzipped:
+            page = gzip.GzipFile(fileobj=StringIO.StringIO(page)).read()
+        return page.decode()
+
+    @staticmethod
+    def parse(seed):
+        """Return the (types, uids) of a seed line, a line may hold a
+        comma separated list of user ids"""
         seed = seed.split()
         # Type unspecified on line, assumed to be user_id
         if len(seed) < 2:
@@ -155,23 +561,56 @@ class _CrawlerWorker(threading.Thread):
             if '*' in types:
                 types = 'utf'
             uid = seed[1]
+        return (types, uid.split(','))
+
+    @staticmethod
+    def priority(seed):
+        """Return the priority of a seed line, its optional third column"""
+        seed = seed.split()
+        try:
+            return float(seed[2])
+        except (IndexError, ValueError):
+            return 0
+
+    def plans(self, seed):
+        """Yield the fetch plans of a seed line"""
+        (types, uids) = _SeedFetcher.parse(seed)
         # download info based on type
-        if _CrawlerWorker.CRAWL_USERINFO in types:
-            self.fetch_userinfo(uid)
-        if _CrawlerWorker.CRAWL_FRIENDS in types:
-            self.fetch_friends(uid)
-        if _CrawlerWorker.CRAWL_TWEETS in types:
-            self.fetch_tweets(uid)
+        if _SeedFetcher.CRAWL_USERINFO in types:
+            if len(uids) > 1:
+                yield self.fetch_userinfo_batch(uids)
+            else:
+                yield self.fetch_userinfo(uids[0])
+        for uid in uids:
+            if _SeedFetcher.CRAWL_FRIENDS in types:
+                yield self.fetch_friends(uid)
+            if _SeedFetcher.CRAWL_TWEETS in types:
+                yield self.fetch_tweets(uid)
 
     def fetch_userinfo(self, uid):
         self.logger.debug("start fetching userinfo for uid:%s " % uid)
-        url = "http://api.twitter.com/1/users/show.json?user_id=" + uid
-        (page, gzipped) = self.gethttpresponse(url)
+        url = "%s/users/show.json?user_id=%s" % (self.api, uid)
+        (page, gzipped) = yield (url, False)
         if not page:
             return
         self.cache("userinfo.json", uid, page, gzipped)
         self.logger.debug("fetched userinfo for uid:%s " % uid)
 
+    def fetch_userinfo_batch(self, uids):
+        """look up to 100 users up in one request and cache every user in
+        the response separately, so the processor sees one file per user"""
+        self.logger.debug("start looking up userinfo for %d uids" % len(uids))
+        url = "%s/users/lookup.json?user_id=%s" % (self.api, ",".join(uids))
+        (page, gzipped) = yield (url, False)
+        if not page:
+            return
+        users = json.loads(_SeedFetcher.decode(page, gzipped))
+        for user in users:
+            self.cache("userinfo.json", str(user['id']), json.dumps(user))
+        # suspended and deleted users are left out of the response
+        self.logger.debug("looked up userinfo for %d of %d uids" %
+                (len(users), len(uids)))
+
     def fetch_friends(self, uid):
         """reads first page of friends (people uid follows), tries 5 times
         if it fails with a 5xx error and finally reads next page if one is
@@ -179,9 +618,9 @@ class _CrawlerWorker(threading.Thread):
         self.logger.debug("start fetching friends for uid:%s" % uid)
         next_cursor = -1
         while(next_cursor != 0):      # while friend list is not complete
-            url = ("http://api.twitter.com/1/friends/ids.json?"
-                   "user_id=%s&cursor=%s" % (uid, next_cursor))
-            (page, gzipped) = self.gethttpresponse(url)
+            url = ("%s/friends/ids.json?user_id=%s&cursor=%s" %
+                   (self.api, uid, next_cursor))
+            (page, gzipped) = yield (url, False)
             if not page:
                 return
             data = json.loads(page.decode())
@@ -190,15 +629,119 @@ class _CrawlerWorker(threading.Thread):
         self.logger.debug("fetched friends for uid:%s" % uid)
 
     def fetch_tweets(self, uid):
+        """reads the tweets uid posted since the last crawl, paging back
+        with max_id until an empty page or the watermark.  Short pages say
+        nothing, count applies before retweets and deleted tweets are left
+        out.  The watermark only moves once the gap to it is closed, within
+        crawl_tweet_pages pages, and only counts once this instance is
+        loaded.  A user never seen before gets one page of the latest
+        tweets"""
         self.logger.debug("start fetching tweets for uid:%s" % uid)
-        url = ("http://api.twitter.com/1/statuses/user_timeline.json?"
-                "include_entities=t&trim_user=t&user_id=%s&count=200" % uid)
-        (page, gzipped) = self.gethttpresponse(url, True)
-        if not page:
-            return
-        self.cache("tweets.json", uid, page, gzipped)
+        count = 200
+        since_id = self.cache_accessor.check_cache(uid)
+        newest = since_id
+        url = ("%s/statuses/user_timeline.json?"
+                "include_entities=t&trim_user=t&user_id=%s&count=%s" %
+                (self.api, uid, count))
+        if since_id > 0:
+            url += "&since_id=%s" % since_id
+        max_id = None
+        closed = False
+        for page_number in xrange(self.config.get('crawl_tweet_pages', 16)):
+            if max_id:
+                (page, gzipped) = yield (url + "&max_id=%s" % max_id, True)
+            else:
+                (page, gzipped) = yield (url, True)
+            if not page:
+                return          # keep the old watermark, retry next crawl
+            tweets = json.loads(_SeedFetcher.decode(page, gzipped))
+            if tweets or not max_id:
+                self.cache("tweets.json", uid, page, gzipped)
+            if not tweets:
+                closed = True   # nothing left between max_id and since_id
+                break
+            ids = [t['id'] for t in tweets]
+            newest = max(newest, max(ids))
+            max_id = min(ids) - 1
+            if since_id <= 0 or max_id <= since_id:
+                closed = True
+                break
+        if not closed:
+            self.logger.info("tweets of uid:%s go back more than %d pages, "
+                             "keeping the watermark" % (uid, page_number + 1))
+        elif newest > since_id:
+            self.cache_accessor.update_watermark(uid, newest)
         self.logger.debug("fetched tweets for uid:%s" % uid)
 
+
+class _CrawlerWorker(threading.Thread, _SeedFetcher):
+    """ _CrawlerWorker represents a worker that crawl and save info"""
+    TERMINATE_SIGNAL = 'TERMINATE'
+
+    def __init__(self, idqueue, config, logger, cachedir, ratelimiter,
+            pool, backoff, stats):
+        threading.Thread.__init__(self)
+        _SeedFetcher.__init__(self, config, logger, cachedir)
+        self.idqueue = idqueue
+        self.ratelimiter = ratelimiter
+        self.pool = pool
+        self.backoff = backoff
+        self.stats = stats
+
+    def gethttpresponse(self, url, datagzipped=False):
+        """Get http response for url, ignore the header and return a
+        pair consists of the content and whether the content is gzipped"""
+        request_headers = {}
+        if datagzipped:
+            request_headers['Accept-encoding'] = 'gzip'
+        for attempt in xrange(9):
+            self.backoff.wait()             # block while crawler is paused
+            self.ratelimiter.acquire()      # block while out of quota
+            start = time.time()
+            try:
+                (code, headers, body) = self.pool.request(url,
+                        request_headers)
+                self.stats.record(time.time() - start, len(body))
+            except (httplib.HTTPException, socket.error) as e:
+                self.logger.debug("Connection error on attempt _%s_ %s: %s" %
+                        (attempt, url, e))
+                time.sleep(self.backoff.failure(attempt))
+                continue
+            self.ratelimiter.update(headers)
+            if code == 200:
+                self.backoff.success()
+                return (body, headers.get('content-encoding'))
+            elif code in BackoffController.RATE_LIMITED:
+                # every worker waits until the reset
+                self.backoff.rate_limited(code, headers)
+            elif code == 401:
+                # User doesn't allow public access
+                self.backoff.success()
+                return (None, None)
+            elif code == 404:
+                # User doesn't exist anymore
+                self.backoff.success()
+                return (None, None)
+            else:
+                self.logger.debug("HTTP code %s on attempt _%s_ %s" %
+                        (code, attempt, url))
+                time.sleep(self.backoff.failure(attempt))
+        self.logger.error('HTTP fetching failure for %s' % url)
+        return (None, None)
+
+    def fetch(self, seed):
+        for plan in self.plans(seed):
+            self.execute(plan)
+
+    def execute(self, plan):
+        """Drive a fetch plan, answering each request with a download"""
+        try:
+            request = plan.next()
+            while True:
+                request = plan.send(self.gethttpresponse(*request))
+        except StopIteration:
+            pass
+
     def run(self):
         # get seed from queue and crawl until terminating signal encountered
         while True:
@@ -215,9 +758,208 @@ class _CrawlerWorker(threading.Thread):
                 self.logger.error(str(e))
                 self.idqueue.task_done()
                 break
+        self.cache_accessor.close()
         self.logger.debug("terminate signal received, closing thread")
 
 
+class _AsyncEngine(_SeedFetcher):
+    """Crawl engine running many fetch plans on one thread
+
+    Every seed in flight has at most one outstanding request, issued over a
+    non-blocking socket and multiplexed with asyncore.  Retries, quota waits
+    and timeouts are timers on the same loop, so nothing blocks except the
+    occasional rate limit status probe.
+    """
+    def __init__(self, config, logger, cachedir, ratelimiter, backoff,
+            stats):
+        _SeedFetcher.__init__(self, config, logger, cachedir)
+        self.ratelimiter = ratelimiter
+        self.backoff = backoff
+        self.stats = stats
+        self.concurrency = self.config.get('crawl_async_concurrency', 100)
+        self.timeout = self.config.get('crawl_async_timeout', 60)
+        self.socket_map = {}
+        self.timers = []        # heap of (when, sequence, callback)
+        self.sequence = 0
+        self.active = 0
+        self.addresses = {}     # resolved hosts
+        self.use_poll = hasattr(select, 'poll')
+
+    def run(self, seeds):
+        """Crawl every seed, return when all of them are done"""
+        self.seeds = iter(seeds)
+        self.fill()
+        while self.active:
+            delay = self.timeout
+            if self.timers:
+                delay = max(0, min(delay, self.timers[0][0] - time.time()))
+            if self.socket_map:
+                asyncore.loop(delay, self.use_poll, self.socket_map, 1)
+            else:
+                time.sleep(delay)
+            now = time.time()
+            while self.timers and self.timers[0][0] <= now:
+                (when, sequence, callback) = heapq.heappop(self.timers)
+                callback()
+            self.fill()
+        self.cache_accessor.close()
+
+    def fill(self):
+        """Start seeds until crawl_async_concurrency are in flight"""
+        while self.active < self.concurrency:
+            try:
+                seed = self.seeds.next()
+            except StopIteration:
+                return
+            self.active += 1
+            self.logger.debug("engine gets: " + seed)
+            self.next_plan(self.plans(seed))
+
+    def schedule(self, delay, callback):
+        self.sequence += 1
+        heapq.heappush(self.timers,
+                (time.time() + delay, self.sequence, callback))
+
+    def next_plan(self, plans):
+        """Start the next plan of a seed, retire the seed after the last"""
+        for plan in plans:
+            self.step(plans, plan, None)
+            return
+        self.active -= 1
+
+    def step(self, plans, plan, response):
+        """Advance plan with the response to its previous request"""
+        try:
+            if response is None:
+                request = plan.next()
+            else:
+                request = plan.send(response)
+        except StopIteration:
+            self.next_plan(plans)
+            return
+        except Exception as e:
+            self.logger.error(str(e))
+            self.next_plan(plans)
+            return
+        def done(response):
+            self.step(plans, plan, response)
+        self.request(request[0], request[1], done, 0)
+
+    def request(self, url, datagzipped, done, attempt):
+        """Download url on the loop, call done with (content, gzipped)"""
+        if attempt >= 9:
+            self.logger.error('HTTP fetching failure for %s' % url)
+            done((None, None))
+            return
+        paused = self.backoff.paused_for()
+        if paused or not self.ratelimiter.acquire(False):
+            # paused or out of quota, come back without spending an attempt
+            self.schedule(max(1, paused, self.ratelimiter.delay()),
+                    lambda: self.request(url, datagzipped, done, attempt))
+            return
+        def retry(delay):
+            self.schedule(delay,
+                    lambda: self.request(url, datagzipped, done, attempt + 1))
+        start = time.time()
+        def respond(code, headers, body, error):
+            if error is None:
+                self.stats.record(time.time() - start, len(body))
+            else:
+                self.logger.debug("Connection error on attempt _%s_ %s: %s" %
+                        (attempt, url, error))
+                retry(self.backoff.failure(attempt))
+                return
+            self.ratelimiter.update(headers)
+            if code == 200:
+                self.backoff.success()
+                done((body, headers.get('content-encoding')))
+            elif code in BackoffController.RATE_LIMITED:
+                # every request waits until the reset
+                self.backoff.rate_limited(code, headers)
+                retry(0)
+            elif code in (401, 404):
+                # private or deleted user
+                self.backoff.success()
+                done((None, None))
+            else:
+                self.logger.debug("HTTP code %s on attempt _%s_ %s" %
+                        (code, attempt, url))
+                retry(self.backoff.failure(attempt))
+        try:
+            (scheme, netloc, path, query, fragment) = urlparse.urlsplit(url)
+            if query:
+                path += '?' + query
+            (host, port) = urllib.splitport(netloc)
+            port = int(port or 80)
+            if host not in self.addresses:
+                self.addresses[host] = socket.gethostbyname(host)
+            _AsyncRequest(self, (self.addresses[host], port), netloc, path,
+                    datagzipped, respond)
+        except (socket.error, ValueError) as e:
+            respond(None, None, None, e)
+
+
+class _AsyncRequest(asyncore.dispatcher):
+    """One HTTP/1.0 GET over a non-blocking socket"""
+    def __init__(self, engine, address, host, path, datagzipped, respond):
+        asyncore.dispatcher.__init__(self, map=engine.socket_map)
+        self.respond = respond
+        self.finished = False
+        self.outgoing = "GET %s HTTP/1.0\r\nHost: %s\r\n" % (path, host)
+        if datagzipped:
+            self.outgoing += "Accept-encoding: gzip\r\n"
+        self.outgoing += "\r\n"
+        self.incoming = []
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        engine.schedule(engine.timeout, self.expire)
+        try:
+            self.connect(address)
+        except socket.error as e:
+            self.fail(e)
+
+    def writable(self):
+        return not self.connected or len(self.outgoing) > 0
+
+    def handle_connect(self):
+        pass
+
+    def handle_write(self):
+        sent = self.send(self.outgoing)
+        self.outgoing = self.outgoing[sent:]
+
+    def handle_read(self):
+        self.incoming.append(self.recv(65536))
+
+    def handle_close(self):
+        self.close()
+        if self.finished:
+            return
+        self.finished = True
+        response = ''.join(self.incoming)
+        try:
+            (head, body) = response.split('\r\n\r\n', 1)
+            (status, head) = (head.split('\r\n', 1) + [''])[:2]
+            code = int(status.split()[1])
+            headers = mimetools.Message(StringIO.StringIO(head))
+        except (ValueError, IndexError):
+            self.respond(None, None, None, 'malformed response')
+            return
+        self.respond(code, headers, body, None)
+
+    def handle_error(self):
+        self.fail(sys.exc_info()[1])
+
+    def expire(self):
+        self.fail('timed out')
+
+    def fail(self, error):
+        self.close()
+        if self.finished:
+            return
+        self.finished = True
+        self.respond(None, None, None, error)
+
+
 def main():
     # Load global configurations
     fp = open('config.json')
@@ -3,11 +3,19 @@
 import os
 import json
 import logging
+import optparse
 import traceback
 
 import misc
 
 class Generator():
+    """Writes seed files of the users not crawled yet that most crawled
+    users follow
+
+    With seed_frontier the loader keeps their in-degrees in the frontier
+    table as friends rows arrive, and the top ones are an index read away.
+    An empty frontier is built from friends once, as rebuild_frontier does.
+    """
     def __init__(self, config, logger):
         self.config = config
         self.logger = logger
@@ -15,10 +23,7 @@ class Generator():
         try:
             if not os.path.exists(dir_seeds):
                 os.makedirs(dir_seeds)
-            self.db = misc.mysql_db(self.config['db_server'],
-                    self.config['db_username'],
-                    self.config['db_password'],
-                    self.config['db_database'], self.logger)
+            self.db = misc.connect_db(self.config, self.logger)
         except Exception as e:
             traceback.print_stack()
             self.logger.error(str(e))
@@ -28,11 +33,23 @@ class Generator():
             # TODO improve our naive seed generation method
             #---------------------------------
             # select the top _seed_limit_ most re-occuring friend that
-            # has yet to be crawled
-            stmt = ("SELECT friend_id FROM friends WHERE friend_id NOT IN "
-                    "(SELECT user_id FROM users_update) "
-                    "group by friend_id order by count(*) desc limit %s" %
-                    self.config['seed_limit'])
+            # has yet to be crawled, in-degree is the crawl priority
+            if self.config.get('seed_frontier', 0):
+                self.db.execute("SELECT 1 FROM frontier LIMIT 1")
+                if self.db.cursor.fetchone() is None:
+                    self.rebuild_frontier()
+                # users crawled while the loader counted them may linger
+                stmt = ("SELECT user_id, in_degree FROM frontier "
+                        "WHERE NOT EXISTS (SELECT 1 FROM users_update "
+                        "WHERE users_update.user_id = frontier.user_id) "
+                        "ORDER BY in_degree DESC LIMIT %s" %
+                        self.config['seed_limit'])
+            else:
+                stmt = ("SELECT friend_id, count(*) FROM friends "
+                        "WHERE friend_id NOT IN "
+                        "(SELECT user_id FROM users_update) "
+                        "group by friend_id order by count(*) desc limit %s" %
+                        self.config['seed_limit'])
             self.db.execute(stmt)
             self.logger.debug("MySQL generate_users Query Complete")
             seedType = 'utf'
@@ -47,8 +64,27 @@ class Generator():
             traceback.print_stack()
             self.logger.error(str(e))
 
+    def rebuild_frontier(self):
+        """Count the in-degrees of the users not crawled yet from the whole
+        friends table, when the loader did not keep them"""
+        self.logger.info("Rebuilding the frontier from friends")
+        self.db.execute("DELETE FROM frontier")
+        self.db.execute("INSERT INTO frontier (user_id, in_degree) "
+                        "SELECT friend_id, count(*) FROM friends "
+                        "WHERE friend_id NOT IN "
+                        "(SELECT user_id FROM users_update) "
+                        "GROUP BY friend_id")
+        self.db.conn.commit()
+
 
 def main():
+    parser = optparse.OptionParser(usage='%prog [options]\n\nWrite seed '
+            'files of the users to crawl next')
+    parser.add_option('--rebuild-frontier', action='store_true',
+                      help='count the frontier again from friends, after '
+                           'loading with seed_frontier off')
+    (opts, args) = parser.parse_args()
+
     # Load global configurations
     fp = open('config.json')
     config = json.load(fp)
@@ -67,6 +103,8 @@ def main():
 
     # Generate seeds
     generator = Generator(config, logger)
+    if opts.rebuild_frontier:
+        generator.rebuild_frontier()
     generator.generate()
 
 
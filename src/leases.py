@@ -0,0 +1,325 @@
+#!/usr/bin/python2.6
+from __future__ import with_statement
+from __future__ import print_function
+import os
+import sys
+import time
+import errno
+import random
+import socket
+import shutil
+import logging
+import threading
+
+import misc
+
+GENERATE = '__generate__'   # lease on generating new seed files
+
+
+def create(config, logger):
+    """Return the lease backend named by lease_backend in config"""
+    backend = config.get('lease_backend', 'none')
+    if backend == 'file':
+        return FileLeases(config, logger)
+    if backend == 'mysql':
+        return MysqlLeases(config, logger)
+    return NoLeases(config, logger)
+
+
+class NoLeases:
+    """Single node, every seed file belongs to us"""
+    def __init__(self, config, logger):
+        self.config = config
+        self.logger = logger
+        self.node = '%s:%s' % (socket.gethostname(), os.getpid())
+
+    def claim(self, key):
+        return True
+
+    def release(self, key):
+        pass
+
+
+class _Leases(NoLeases):
+    """Expiring leases on seed files shared by several crawler nodes
+
+    A node claims a seed file before crawling it and a background thread
+    renews every lease it holds each lease_ttl / 3 seconds.  A node that
+    dies stops renewing, its leases expire after lease_ttl seconds and the
+    seed files go back to the pool for the other nodes to claim.
+    Subclasses implement try_claim, try_renew and try_release.
+    """
+    def __init__(self, config, logger):
+        NoLeases.__init__(self, config, logger)
+        self.ttl = self.config.get('lease_ttl', 600)
+        self.lock = threading.Lock()
+        self.held = {}
+        self.renewer = None
+
+    def claim(self, key):
+        """Take the lease on key, return False if another node holds it"""
+        self.start_renewer()
+        # the node id must follow us across the fork in Twaler.twale
+        self.node = '%s:%s' % (socket.gethostname(), os.getpid())
+        try:
+            token = self.try_claim(key)
+        except Exception as e:
+            self.logger.error('Failed claiming lease on %s: %s' % (key, e))
+            return False
+        if token is None:
+            return False
+        with self.lock:
+            self.held[key] = token
+        self.logger.debug('%s claimed %s' % (self.node, key))
+        return True
+
+    def holds(self, key):
+        with self.lock:
+            return key in self.held
+
+    def renew(self, key):
+        """Extend the lease on key, return False if it was lost"""
+        with self.lock:
+            token = self.held.get(key)
+        if token is None:
+            return False
+        try:
+            if self.try_renew(key, token):
+                return True
+        except Exception as e:
+            self.logger.error('Failed renewing lease on %s: %s' % (key, e))
+            return True     # keep it, the next renewal may get through
+        self.logger.warning('%s lost lease on %s' % (self.node, key))
+        with self.lock:
+            self.held.pop(key, None)
+        return False
+
+    def release(self, key):
+        with self.lock:
+            token = self.held.pop(key, None)
+        if token is None:
+            return
+        try:
+            self.try_release(key, token)
+        except Exception as e:
+            self.logger.error('Failed releasing lease on %s: %s' % (key, e))
+
+    def start_renewer(self):
+        # threads do not survive a fork, start one in the working process
+        if self.renewer is None or not self.renewer.isAlive():
+            self.renewer = threading.Thread(target=self.renew_forever)
+            self.renewer.setDaemon(True)
+            self.renewer.start()
+
+    def renew_forever(self):
+        while True:
+            time.sleep(self.ttl / 3.0)
+            with self.lock:
+                keys = self.held.keys()
+            for key in keys:
+                self.renew(key)
+
+
+class FileLeases(_Leases):
+    """Leases kept as files under dir_leases, for nodes sharing a filesystem
+
+    Every claim of a seed file creates the next numbered generation file
+    in dir_leases/<seed>/ with O_EXCL, so when several nodes race for an
+    expired lease exactly one of them gets the new generation.  The highest
+    generation is the holder, it writes its node id and expiry time into
+    its generation file.  Node clocks are assumed to be in sync.
+    """
+    def __init__(self, config, logger):
+        _Leases.__init__(self, config, logger)
+        self.dir_leases = self.config.get('dir_leases', 'leases')
+        if not os.path.exists(self.dir_leases):
+            os.makedirs(self.dir_leases)
+
+    def generations(self, path):
+        try:
+            return sorted([int(name) for name in os.listdir(path)
+                           if name.isdigit()])
+        except OSError:
+            return []
+
+    def expires(self, filename):
+        """Return (node, expiry time) written in a generation file"""
+        try:
+            with open(filename) as fin:
+                (node, expires) = fin.read().split()
+                return (node, float(expires))
+        except ValueError:
+            # created but not written yet, give it a full term
+            return (None, os.path.getmtime(filename) + self.ttl)
+
+    def write(self, filename, expires):
+        # write aside and rename so readers never see half a lease
+        with open(filename + '.tmp', 'w') as fout:
+            fout.write('%s %s' % (self.node, expires))
+        os.rename(filename + '.tmp', filename)
+
+    def try_claim(self, key):
+        path = os.path.join(self.dir_leases, key)
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        generations = self.generations(path)
+        generation = 1
+        if generations:
+            try:
+                (node, expires) = self.expires(
+                        os.path.join(path, str(generations[-1])))
+            except (IOError, OSError):
+                return None     # released or taken over under our feet
+            if expires > time.time():
+                return None
+            generation = generations[-1] + 1
+        filename = os.path.join(path, str(generation))
+        try:
+            fd = os.open(filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError:
+            return None         # another node won the race
+        os.close(fd)
+        self.write(filename, time.time() + self.ttl)
+        for old in generations:
+            try:
+                os.remove(os.path.join(path, str(old)))
+            except OSError:
+                pass
+        return generation
+
+    def try_renew(self, key, generation):
+        path = os.path.join(self.dir_leases, key)
+        if self.generations(path)[-1:] != [generation]:
+            return False        # a newer generation took over
+        self.write(os.path.join(path, str(generation)),
+                   time.time() + self.ttl)
+        return True
+
+    def try_release(self, key, generation):
+        # expire rather than delete, generation numbers must never repeat
+        path = os.path.join(self.dir_leases, key)
+        if self.generations(path)[-1:] == [generation]:
+            self.write(os.path.join(path, str(generation)), 0)
+
+
+class MysqlLeases(_Leases):
+    """Leases kept in the seed_leases table of the twaler database, expiry
+    is computed by the database so node clocks do not matter"""
+    def __init__(self, config, logger):
+        _Leases.__init__(self, config, logger)
+        self.db_lock = threading.Lock()
+        self.db = misc.mysql_db(self.config['db_server'],
+                                self.config['db_username'],
+                                self.config['db_password'],
+                                self.config['db_database'], self.logger)
+
+    def query(self, stmt, values):
+        """Run stmt and commit, return the number of rows it changed"""
+        with self.db_lock:
+            rows = self.db.cursor.execute(stmt, values)
+            self.db.conn.commit()
+            return rows
+
+    def try_claim(self, key):
+        self.query('INSERT IGNORE INTO seed_leases VALUES '
+                   '(%s, %s, NOW() + INTERVAL %s SECOND)',
+                   (key, self.node, self.ttl))
+        self.query('UPDATE seed_leases SET node = %s, '
+                   'expires = NOW() + INTERVAL %s SECOND '
+                   'WHERE seed = %s AND (node = %s OR expires < NOW())',
+                   (self.node, self.ttl, key, self.node))
+        if self.owner(key) == self.node:
+            return self.node
+        return None
+
+    def try_renew(self, key, node):
+        self.query('UPDATE seed_leases SET '
+                   'expires = NOW() + INTERVAL %s SECOND '
+                   'WHERE seed = %s AND node = %s', (self.ttl, key, node))
+        return self.owner(key) == node
+
+    def owner(self, key):
+        """Return the node holding the lease on key, or None.  An update to
+        the same expiry counts as no change, so its row count cannot tell"""
+        with self.db_lock:
+            self.db.cursor.execute(
+                    'SELECT node FROM seed_leases WHERE seed = %s', (key,))
+            row = self.db.cursor.fetchone()
+        if row:
+            return row[0]
+        return None
+
+    def try_release(self, key, node):
+        self.query('DELETE FROM seed_leases WHERE seed = %s AND node = %s',
+                   (key, node))
+
+
+def _node(config, keys, dir_done, die_after):
+    """A node of the self-check, moves every seed it finishes to dir_done
+    and may die holding a lease"""
+    logger = logging.getLogger('')
+    leases = create(config, logger)
+    done = 0
+    while True:
+        pending = [key for key in keys
+                   if not os.path.exists(os.path.join(dir_done, key))]
+        if not pending:
+            return
+        random.shuffle(pending)
+        for key in pending:
+            if not leases.claim(key):
+                continue
+            if os.path.exists(os.path.join(dir_done, key)):
+                leases.release(key)
+                continue
+            time.sleep(random.uniform(0, 0.2))      # pretend to crawl
+            if done == die_after:
+                os._exit(1)                         # die holding the lease
+            with open(os.path.join(dir_done, key), 'a') as fout:
+                fout.write('%s\n' % leases.node)
+            done += 1
+            leases.release(key)
+        time.sleep(0.1)
+
+
+def main():
+    """Self-check: several processes on this machine compete for the same
+    seeds through file leases, some of them dying while holding one"""
+    import tempfile
+    import multiprocessing
+
+    logging.basicConfig(level=logging.INFO)
+    nodes = 4
+    if len(sys.argv) > 1:
+        nodes = int(sys.argv[1])
+    workdir = tempfile.mkdtemp()
+    dir_done = os.path.join(workdir, 'done')
+    os.makedirs(dir_done)
+    config = {'lease_backend': 'file', 'lease_ttl': 2,
+              'dir_leases': os.path.join(workdir, 'leases')}
+    keys = ['seeds_%d.txt' % i for i in range(40)]
+    processes = []
+    for i in range(nodes):
+        # every other node dies after its third seed
+        die_after = 3 if i % 2 else -1
+        process = multiprocessing.Process(target=_node,
+                args=(config, keys, dir_done, die_after))
+        process.start()
+        processes.append(process)
+    for process in processes:
+        process.join()
+    finished = os.listdir(dir_done)
+    twice = [key for key in finished
+             if len(open(os.path.join(dir_done, key)).readlines()) > 1]
+    print('%d of %d seeds done by %d nodes, %d done twice' %
+          (len(finished), len(keys), nodes, len(twice)))
+    shutil.rmtree(workdir, True)
+    if twice or len(finished) < len(keys):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
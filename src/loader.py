@@ -1,16 +1,97 @@
 #!/usr/bin/python2.6
 import os
 import sys
+import gzip
 import json
+import time
+import Queue
+import shutil
 import logging
+import itertools
+import threading
+from contextlib import closing
+from contextlib import contextmanager
+
+import misc
+
+class LoadError(Exception):
+    pass
+
+
+def create(config, logger):
+    """Return the loader for the database named by db_backend in config"""
+    if config.get('db_backend', 'mysql') == 'sqlite':
+        return SqliteLoader(config, logger)
+    return Loader(config, logger)
+
 
 class Loader():
+    """Bulk loads processed tables into the database
+
+    Statements that belong together run in one transaction.  With
+    loader_backend cli a transaction is a mysql client process, with
+    mysqldb it runs on a connection of a pool kept open across loads,
+    reporting rows affected and time of every statement.  A failing
+    transaction is rolled back and load returns False.
+
+    friends_touch goes first, then loader_workers threads load the other
+    tables side by side.  Tables longer than loader_chunk_rows rows are
+    loaded a chunk per transaction.  loader_defer_indexes keeps secondary
+    indexes out of the way of a big backfill: disable runs ALTER TABLE
+    DISABLE KEYS (MyISAM only), drop drops the non unique indexes and adds
+    them back after the load (mysqldb backend only).
+
+    With seed_frontier the frontier table of the generator follows the
+    load: friends rows new to the database add to the in-degree of a
+    friend not crawled yet, users landing in users_update leave it.  Side
+    by side the two would lock frontier rows in different orders and
+    deadlock, so users_update loads first and friends after it.
+    """
     def __init__(self, config, logger):
         self.config = config
         self.logger = logger
         self.prefix = ('mysql -u %s -p%s %s -e ' %
                 (self.config['db_username'], self.config['db_password'],
                  self.config['db_database']))
+        self.pool = None
+        if self.config.get('loader_backend', 'cli') == 'mysqldb':
+            self.pool = misc.mysql_pool(self.config['db_server'],
+                                        self.config['db_username'],
+                                        self.config['db_password'],
+                                        self.config['db_database'],
+                                        self.logger,
+                                        self.config.get('loader_pool_size', 4))
+        self.workers = max(1, self.config.get('loader_workers', 1))
+        self.chunk_rows = self.config.get('loader_chunk_rows', 0)
+        self.defer = self.config.get('loader_defer_indexes', '')
+        self.frontier = self.config.get('seed_frontier', 0)
+
+    @contextmanager
+    def transaction(self):
+        """Statements executed on the transaction yielded are committed
+        together, or not at all"""
+        trans = self.begin()
+        try:
+            yield trans
+            trans.commit()
+        except:
+            trans.rollback()
+            raise
+        finally:
+            trans.close()
+
+    def begin(self):
+        if self.pool is None:
+            return _CliTransaction(self)
+        return _DbTransaction(self, self.pool.checkout())
+
+    def report(self, stmt, rows, seconds, info=None):
+        """Log what a statement did"""
+        line = '%8.3f s %10s rows  %s' % (seconds, rows, ' '.join(
+                stmt.split())[:100])
+        if info:
+            line += '  (%s)' % info
+        self.logger.info(line)
 
     """Bulk Load a File"""
     def dump(self, table, filename, replace=True):
@@ -23,55 +104,480 @@ class Loader():
                 (filename, replace_str, table))
         self.execute(stmt)
 
+    """Bulk Load a File a chunk at a time"""
+    def dump_chunked(self, table, filename, replace=True):
+        for chunk in self.chunks(filename):
+            self.dump(table, chunk, replace)
+
     """Bulk Load + Update by loading to a temporary table first"""
     def dump_and_update(self, table, filename, update_keys):
-        # Clear out temp table
-        stmt = "DELETE FROM temp." + table
-        self.execute(stmt)
-        # Bulk load to table
-        stmt = ("LOAD DATA LOCAL INFILE \"%s\" INTO TABLE temp.%s FIELDS "
-                "TERMINATED BY \"\\t\" LINES TERMINATED BY \"\\n\"" %
-                (filename, table))
-        self.execute(stmt)
-        # Insert/update to official table
-        stmt = ("INSERT INTO %s SELECT * FROM temp.%s ON DUPLICATE KEY "
-                "UPDATE " % (table, table))
-        for key in update_keys:
-            stmt += "%s= temp.%s.%s,"%(key, table, key)
-        stmt = stmt[:-1]        # wipe out the extra comma
-        self.execute(stmt)
-        #delete temp table
-        stmt = "DELETE FROM temp."+table
-        self.execute(stmt)
+        for chunk in self.chunks(filename):
+            self.update_chunk(table, chunk, update_keys)
+
+    def update_chunk(self, table, filename, update_keys):
+        with self.transaction() as trans:
+            # Clear out temp table
+            stmt = "DELETE FROM temp." + table
+            trans.execute(stmt)
+            # Bulk load to table
+            stmt = ("LOAD DATA LOCAL INFILE \"%s\" INTO TABLE temp.%s "
+                    "FIELDS TERMINATED BY \"\\t\" LINES TERMINATED BY "
+                    "\"\\n\"" % (filename, table))
+            trans.execute(stmt)
+            if self.frontier and table == "friends":
+                # count the edges before they are in friends
+                stmt = ("INSERT INTO frontier (user_id, in_degree) "
+                        "SELECT s.friend_id, COUNT(DISTINCT s.user_id) "
+                        "FROM temp.friends s LEFT JOIN friends f ON "
+                        "f.user_id = s.user_id AND f.friend_id = s.friend_id "
+                        "LEFT JOIN users_update u ON u.user_id = s.friend_id "
+                        "WHERE f.user_id IS NULL AND u.user_id IS NULL "
+                        "GROUP BY s.friend_id ON DUPLICATE KEY UPDATE "
+                        "in_degree = frontier.in_degree + VALUES(in_degree)")
+                trans.execute(stmt)
+            # Insert/update to official table
+            stmt = ("INSERT INTO %s SELECT * FROM temp.%s ON DUPLICATE KEY "
+                    "UPDATE " % (table, table))
+            for key in update_keys:
+                stmt += "%s= temp.%s.%s,"%(key, table, key)
+            stmt = stmt[:-1]        # wipe out the extra comma
+            trans.execute(stmt)
+            if self.frontier and table == "users_update":
+                stmt = ("DELETE frontier FROM frontier JOIN temp.users_update "
+                        "ON frontier.user_id = temp.users_update.user_id")
+                trans.execute(stmt)
+            #delete temp table
+            stmt = "DELETE FROM temp."+table
+            trans.execute(stmt)
+
+    """Move date_last of the friends a user had at the last crawl, but for
+    the ones in unfollows"""
+    def touch_friends(self, filename, unfollows=None):
+        with self.transaction() as trans:
+            for table in ('friends_touch', 'unfollows'):
+                trans.execute("DELETE FROM temp." + table)
+            stmt = ("LOAD DATA LOCAL INFILE \"%s\" INTO TABLE "
+                    "temp.friends_touch FIELDS TERMINATED BY \"\\t\" LINES "
+                    "TERMINATED BY \"\\n\"" % filename)
+            trans.execute(stmt)
+            if unfollows:
+                stmt = ("LOAD DATA LOCAL INFILE \"%s\" INTO TABLE "
+                        "temp.unfollows FIELDS TERMINATED BY \"\\t\" LINES "
+                        "TERMINATED BY \"\\n\"" % unfollows)
+                trans.execute(stmt)
+            # must run before users_update moves friend_updated
+            stmt = ("UPDATE friends JOIN users_update ON "
+                    "users_update.user_id = friends.user_id JOIN "
+                    "temp.friends_touch ON "
+                    "temp.friends_touch.user_id = friends.user_id LEFT JOIN "
+                    "temp.unfollows ON "
+                    "temp.unfollows.user_id = friends.user_id AND "
+                    "temp.unfollows.friend_id = friends.friend_id SET "
+                    "friends.date_last = temp.friends_touch.date_last WHERE "
+                    "friends.date_last = users_update.friend_updated AND "
+                    "temp.unfollows.user_id IS NULL")
+            trans.execute(stmt)
+            stmt = "INSERT IGNORE INTO unfollows SELECT * FROM temp.unfollows"
+            trans.execute(stmt)
+            for table in ('friends_touch', 'unfollows'):
+                trans.execute("DELETE FROM temp." + table)
 
     def execute(self, stmt):
-        cmd = "%s '%s'" % (self.prefix, stmt)
-        os.system(cmd)
-        self.logger.debug("executed:" + stmt)
+        with self.transaction() as trans:
+            trans.execute(stmt)
+
+    def chunks(self, filename):
+        """Yield filename, or files of loader_chunk_rows of its rows written
+        next to it and removed once loaded"""
+        if not self.chunk_rows:
+            yield filename
+            return
+        with closing(open(filename, 'rb')) as fin:
+            for part in itertools.count():
+                rows = list(itertools.islice(fin, self.chunk_rows))
+                if part == 0 and len(rows) < self.chunk_rows:
+                    yield filename      # small enough as it is
+                    return
+                if not rows:
+                    return
+                chunk = '%s.%04d' % (filename, part)
+                with closing(open(chunk, 'wb', 1024 * 1024)) as fout:
+                    fout.writelines(rows)
+                del rows
+                try:
+                    yield chunk
+                finally:
+                    os.remove(chunk)
+
+    def secondary_indexes(self, table):
+        """Return [(index name, [columns])] of the non unique indexes of
+        table"""
+        conn = self.pool.checkout()
+        broken = False
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SHOW INDEX FROM %s' % table)
+            rows = cursor.fetchall()
+            cursor.close()
+        except Exception:
+            broken = True
+            raise
+        finally:
+            self.pool.checkin(conn, broken)
+        indexes = {}
+        # Table, Non_unique, Key_name, Seq_in_index, Column_name, ...
+        for row in sorted(rows, key=lambda row: (row[2], row[3])):
+            if int(row[1]) and row[2] != 'PRIMARY':
+                indexes.setdefault(row[2], []).append(row[4])
+        return sorted(indexes.items())
+
+    def defer_indexes(self, tables):
+        """Take the secondary indexes of tables out of the way as
+        loader_defer_indexes says, return the statements putting them
+        back"""
+        restore = []
+        if not self.defer:
+            return restore
+        if self.defer not in ('disable', 'drop'):
+            self.logger.warning('Unknown loader_defer_indexes %s' %
+                                self.defer)
+            return restore
+        if self.defer == 'drop' and self.pool is None:
+            self.logger.warning('loader_defer_indexes drop needs '
+                                'loader_backend mysqldb, keeping indexes')
+            return restore
+        for table in tables:
+            try:
+                if self.defer == 'disable':
+                    self.execute('ALTER TABLE %s DISABLE KEYS' % table)
+                    restore.append('ALTER TABLE %s ENABLE KEYS' % table)
+                    continue
+                indexes = self.secondary_indexes(table)
+                if not indexes:
+                    continue
+                stmt = ('ALTER TABLE %s ' % table + ', '.join(
+                        ['ADD INDEX %s (%s)' % (name, ', '.join(columns))
+                         for (name, columns) in indexes]))
+                # a load that dies half way must not lose them for good
+                self.logger.warning('Dropping indexes of %s, restore with: '
+                                    '%s' % (table, stmt))
+                self.execute('ALTER TABLE %s ' % table + ', '.join(
+                        ['DROP INDEX %s' % name for (name, columns)
+                         in indexes]))
+                restore.append(stmt)
+            except Exception as e:
+                self.logger.error('Keeping indexes of %s: %s' % (table, e))
+        return restore
+
+    def run(self, loads):
+        """Run the (function, args) of loads on loader_workers threads,
+        return the number that failed"""
+        pending = Queue.Queue()
+        for load in loads:
+            pending.put(load)
+        failed = []
+
+        def work():
+            while True:
+                try:
+                    (load, args) = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    load(*args)
+                except Exception as e:
+                    self.logger.error('Loading %s failed: %s' % (args[0], e))
+                    failed.append(args[0])
+
+        threads = [threading.Thread(target=work)
+                   for i in range(min(self.workers, len(loads)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return len(failed)
+
+    def in_order(self, names, loads):
+        """Run the (function, args) of loads one after the other, raise the
+        first error once all were tried.  names stand for them in the
+        messages of run"""
+        error = None
+        for (load, args) in loads:
+            try:
+                load(*args)
+            except Exception as e:
+                self.logger.error('Loading %s failed: %s' % (args[0], e))
+                if error is None:
+                    error = e
+        if error is not None:
+            raise error
+
+    def uncompress(self, dir_data):
+        """LOAD DATA reads plain text, uncompress the .tsv.gz tables of
+        dir_data next to them and return the plain files made"""
+        made = []
+        for filename in os.listdir(dir_data):
+            if not filename.endswith('.tsv.gz'):
+                continue
+            filepath = os.path.join(dir_data, filename)
+            with closing(gzip.open(filepath, 'rb')) as fin:
+                with closing(open(filepath[:-3], 'wb')) as fout:
+                    shutil.copyfileobj(fin, fout, 1024 * 1024)
+            made.append(filepath[:-3])
+        return made
 
     def load(self, dir_data):
+        """Load the tables of dir_data, return False if any failed"""
+        uncompressed = self.uncompress(dir_data)
+        try:
+            return self.load_tables(dir_data)
+        finally:
+            for filepath in uncompressed:
+                os.remove(filepath)
+
+    def load_tables(self, dir_data):
         files = os.listdir(dir_data)
+        loads = []
+        unfollows = None
+        if 'unfollows.tsv' in files:
+            unfollows = os.path.join(dir_data, 'unfollows.tsv')
+        if 'friends_touch.tsv' in files:
+            loads.append((self.touch_friends,
+                          (os.path.join(dir_data, 'friends_touch.tsv'),
+                           unfollows)))
+        elif unfollows:
+            loads.append((self.dump_chunked, ("unfollows", unfollows, False)))
 
         #load each file that corresponds to the table name in the directory
         for filename in files:
             filepath = os.path.join(dir_data, filename)
             if (filename == 'users.tsv'):
-                self.dump("users", filepath)
+                loads.append((self.dump_chunked, ("users", filepath)))
             if (filename == 'tweets.tsv'):
-                self.dump("tweets", filepath)
+                loads.append((self.dump_chunked, ("tweets", filepath)))
             if (filename == 'mentions.tsv'):
-                self.dump("mentions", filepath)
+                loads.append((self.dump_chunked, ("mentions", filepath)))
             if (filename == 'urls.tsv'):
-                self.dump("urls", filepath)
+                loads.append((self.dump_chunked, ("urls", filepath)))
             if (filename == 'hashes.tsv'):
-                self.dump("hashes", filepath)
+                loads.append((self.dump_chunked, ("hashes", filepath)))
             if (filename == 'hashtags.tsv'):
-                self.dump("hashtags", filepath)
+                loads.append((self.dump_chunked, ("hashtags", filepath)))
             if (filename == 'friends.tsv'):
-                self.dump_and_update("friends", filepath, ["date_last"])
+                loads.append((self.dump_and_update,
+                              ("friends", filepath, ["date_last"])))
             if (filename == 'users_update.tsv'):
-                self.dump_and_update("users_update", filepath, [
-                    "info_updated", "tweet_updated", "friend_updated"])
+                loads.append((self.dump_and_update, ("users_update", filepath,
+                    ["info_updated", "tweet_updated", "friend_updated"])))
+        # touches must see friend_updated before users_update moves it
+        first = [load for load in loads if load[0] == self.touch_friends]
+        rest = [load for load in loads if load[0] != self.touch_friends]
+        tables = [args[0] for (load, args) in rest]
+        if self.frontier:
+            frontier = [load for load in rest
+                        if load[1][0] in ('users_update', 'friends')]
+            frontier.sort(key=lambda load: load[1][0] != 'users_update')
+            if len(frontier) > 1:
+                rest = [load for load in rest if load not in frontier]
+                rest.append((self.in_order, ('users_update, friends',
+                                             frontier)))
+        start = time.time()
+        restore = self.defer_indexes(tables)
+        failed = self.run(first) + self.run(rest)
+        for stmt in restore:
+            try:
+                self.execute(stmt)
+            except Exception as e:
+                self.logger.error('Restoring indexes failed, run %s: %s' %
+                                  (stmt, e))
+                failed += 1
+        self.logger.info('Loaded %d tables of %s in %.1f s with %d workers' %
+                         (len(loads), dir_data, time.time() - start,
+                          self.workers))
+        return not failed
+
+
+class SqliteLoader(Loader):
+    """Loads processed tables into the SQLite database db_sqlite
+
+    SQLite has no LOAD DATA, rows are read from the tables and inserted
+    with executemany into temporary stage_<table> tables of the connection
+    where MySQL uses the temp database.  SQLite has a single writer, so the
+    tables load one after the other and indexes are kept.
+    """
+    # unique keys of the tables dump_and_update merges into
+    KEYS = {'friends': ('user_id', 'friend_id'),
+            'users_update': ('user_id',)}
+
+    def __init__(self, config, logger):
+        Loader.__init__(self, config, logger)
+        self.pool = None
+        self.workers = 1
+        self.defer = ''
+        self.db = misc.sqlite_db(self.config.get('db_sqlite', 'twaler.db'),
+                                 self.logger)
+
+    def begin(self):
+        return _SqliteTransaction(self)
+
+    def stage(self, trans, table, filename):
+        """Copy the rows of filename into temp.stage_<table>"""
+        trans.execute("CREATE TEMP TABLE IF NOT EXISTS stage_%s AS "
+                      "SELECT * FROM main.%s WHERE 0" % (table, table))
+        trans.execute("DELETE FROM temp.stage_" + table)
+        self.insert(trans, "INSERT INTO temp.stage_" + table, table,
+                    filename)
+
+    def insert(self, trans, stmt, table, filename):
+        marks = ",".join("?" * len(self.db.columns(table)))
+        trans.execute("%s VALUES(%s)" % (stmt, marks),
+                      misc.file_db.read_rows(filename))
+
+    def dump(self, table, filename, replace=True):
+        if replace:
+            replace_str = "REPLACE"
+        else:
+            replace_str = "IGNORE"
+        with self.transaction() as trans:
+            self.insert(trans, "INSERT OR %s INTO main.%s" %
+                        (replace_str, table), table, filename)
+
+    def update_chunk(self, table, filename, update_keys):
+        with self.transaction() as trans:
+            self.stage(trans, table, filename)
+            if self.frontier and table == "friends":
+                # count the edges before they are in friends
+                trans.execute(
+                        "INSERT INTO main.frontier (user_id, in_degree) "
+                        "SELECT s.friend_id, COUNT(DISTINCT s.user_id) "
+                        "FROM temp.stage_friends s LEFT JOIN main.friends f "
+                        "ON f.user_id = s.user_id AND "
+                        "f.friend_id = s.friend_id LEFT JOIN "
+                        "main.users_update u ON u.user_id = s.friend_id "
+                        "WHERE f.user_id IS NULL AND u.user_id IS NULL "
+                        "GROUP BY s.friend_id ON CONFLICT (user_id) DO "
+                        "UPDATE SET in_degree = in_degree + "
+                        "excluded.in_degree")
+            # WHERE 1 tells the upsert from a join
+            trans.execute("INSERT INTO main.%s SELECT * FROM temp.stage_%s "
+                          "WHERE 1 ON CONFLICT (%s) DO UPDATE SET %s" %
+                          (table, table, ", ".join(SqliteLoader.KEYS[table]),
+                           ", ".join(["%s = excluded.%s" % (key, key)
+                                      for key in update_keys])))
+            if self.frontier and table == "users_update":
+                trans.execute("DELETE FROM main.frontier WHERE user_id IN "
+                              "(SELECT user_id FROM temp.stage_users_update)")
+            trans.execute("DELETE FROM temp.stage_" + table)
+
+    def touch_friends(self, filename, unfollows=None):
+        with self.transaction() as trans:
+            self.stage(trans, "friends_touch", filename)
+            trans.execute("CREATE TEMP TABLE IF NOT EXISTS stage_unfollows "
+                          "AS SELECT * FROM main.unfollows WHERE 0")
+            trans.execute("DELETE FROM temp.stage_unfollows")
+            if unfollows:
+                self.insert(trans, "INSERT INTO temp.stage_unfollows",
+                            "unfollows", unfollows)
+            # must run before users_update moves friend_updated
+            trans.execute(
+                    "UPDATE main.friends SET date_last = "
+                    "(SELECT t.date_last FROM temp.stage_friends_touch t "
+                    "WHERE t.user_id = friends.user_id) "
+                    "WHERE user_id IN "
+                    "(SELECT user_id FROM temp.stage_friends_touch) "
+                    "AND date_last = (SELECT u.friend_updated FROM "
+                    "main.users_update u WHERE u.user_id = friends.user_id) "
+                    "AND NOT EXISTS (SELECT 1 FROM temp.stage_unfollows r "
+                    "WHERE r.user_id = friends.user_id AND "
+                    "r.friend_id = friends.friend_id)")
+            trans.execute("INSERT OR IGNORE INTO main.unfollows "
+                          "SELECT * FROM temp.stage_unfollows")
+            for table in ("friends_touch", "unfollows"):
+                trans.execute("DELETE FROM temp.stage_" + table)
+
+
+class _CliTransaction:
+    """Statements run by one mysql client process at commit, which stops
+    at the first failing one and leaves the transaction uncommitted"""
+    def __init__(self, loader):
+        self.loader = loader
+        self.stmts = []
+
+    def execute(self, stmt):
+        self.stmts.append(stmt)
+
+    def commit(self):
+        stmt = 'START TRANSACTION; %s; COMMIT' % '; '.join(self.stmts)
+        start = time.time()
+        status = os.system("%s '%s'" % (self.loader.prefix, stmt))
+        self.loader.report(stmt, '-', time.time() - start)
+        if status:
+            raise LoadError('mysql exited with status %d' % (status >> 8))
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class _DbTransaction:
+    """Statements run one by one on a pooled connection"""
+    def __init__(self, loader, conn):
+        self.loader = loader
+        self.conn = conn
+        self.broken = False
+
+    def execute(self, stmt):
+        start = time.time()
+        cursor = self.conn.cursor()
+        try:
+            rows = cursor.execute(stmt)
+        finally:
+            cursor.close()
+        self.loader.report(stmt, rows, time.time() - start, self.conn.info())
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        try:
+            self.conn.rollback()
+        except Exception:
+            self.broken = True      # do not hand it out again
+
+    def close(self):
+        self.loader.pool.checkin(self.conn, self.broken)
+
+
+class _SqliteTransaction:
+    """Statements run one by one on the connection of the loader, holding
+    the write lock from the start"""
+    def __init__(self, loader):
+        self.loader = loader
+        self.cursor = loader.db.conn.cursor()
+        self.cursor.execute("BEGIN IMMEDIATE")
+
+    def execute(self, stmt, rows=None):
+        """Run stmt, or with rows run it for every row"""
+        start = time.time()
+        if rows is None:
+            self.cursor.execute(stmt)
+        else:
+            self.cursor.executemany(stmt, rows)
+        self.loader.report(stmt, self.cursor.rowcount, time.time() - start)
+
+    def commit(self):
+        self.cursor.execute("COMMIT")
+
+    def rollback(self):
+        try:
+            self.cursor.execute("ROLLBACK")
+        except Exception:
+            pass        # SQLite rolled back on its own
+
+    def close(self):
+        self.cursor.close()
 
 
 def main():
@@ -99,9 +605,10 @@ def main():
     logger = logging.getLogger('')
     logger.setLevel(logging.DEBUG)
 
-    # Load processed tsvs into mysql database
-    loader = Loader(config, logger)
-    loader.load(sys.argv[1])
+    # Load processed tsvs into the database
+    loader = create(config, logger)
+    if not loader.load(sys.argv[1]):
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -6,8 +6,14 @@ import datetime
 import os
 import gzip
 import re
+import mmap
 import codecs
-import MySQLdb
+import json
+import hashlib
+import sqlite3
+import StringIO
+import itertools
+import threading
 
 from contextlib import closing
 
@@ -30,11 +36,36 @@ class timefunctions:
         dt = datetime.datetime.strptime(dtstr, "%a %b %d %H:%M:%S +0000 %Y")
         return dt.strftime("%Y-%m-%d %H:%M:%S")
 
+    MONTHS = {'Jan': '01', 'Feb': '02', 'Mar': '03', 'Apr': '04',
+              'May': '05', 'Jun': '06', 'Jul': '07', 'Aug': '08',
+              'Sep': '09', 'Oct': '10', 'Nov': '11', 'Dec': '12'}
+
+    @staticmethod
+    def jsonToSqlTimes(dtstrs):
+        """jsonToSqlTime of a whole column, cutting the fixed width fields
+        out instead of a strptime/strftime pair per value"""
+        months = timefunctions.MONTHS
+        times = []
+        for dtstr in dtstrs:
+            # Wed Aug 27 13:08:45 +0000 2008
+            if (len(dtstr) == 30 and dtstr[19:26] == ' +0000 ' and
+                    dtstr[4:7] in months and dtstr[8:10].isdigit()):
+                times.append('%s-%s-%s %s' % (dtstr[26:30], months[dtstr[4:7]],
+                                              dtstr[8:10], dtstr[11:19]))
+            else:
+                times.append(timefunctions.jsonToSqlTime(dtstr))
+        return times
+
     @staticmethod
     def instanceToSqlTime(dtstr):
         dt = datetime.datetime.strptime(dtstr, "%Y.%m.%d.%H.%M.%S")
         return dt.strftime("%Y-%m-%d %H:%M:%S")
 
+    @staticmethod
+    def sqlTimeToInstance(dtstr):
+        dt = datetime.datetime.strptime(dtstr, "%Y-%m-%d %H:%M:%S")
+        return dt.strftime("%Y.%m.%d.%H.%M.%S")
+
     @staticmethod
     def xmlToSqlTime(dtstr):
         # N.B. The time used here is GMT time!!
@@ -48,11 +79,40 @@ class timefunctions:
 
 
 class CacheAccessor():
-    """Cache files writer/reader"""
-    def __init__(self, cache_dir, logger):
+    """Cache files writer/reader
+
+    Every writer also appends uid, request type and file name of each file
+    it stores to its own manifest under cache_dir/manifest, so readers find
+    the users of an instance and their files with one sequential read
+    instead of walking the whole tree.  Instances crawled before manifests
+    existed are still walked.
+
+    Responses of the request types in dedup are hashed and compared with
+    the digest of the same page of the same user in the previous crawl,
+    kept next to the watermarks with the instance that stored the page.
+    An unchanged page is stored as a request_type.ref record holding only
+    the digest and that instance, as long as the instance is loaded; the
+    page is stored again if it failed to load or was evicted.  open_ref
+    reads the page a ref stands for out of its instance.
+    """
+    MANIFEST_DIR = 'manifest'
+    writers = itertools.count()
+    writers_lock = threading.Lock()
+
+    def __init__(self, cache_dir, logger, watermark_dir=None, dedup=()):
         self.cache_dir = cache_dir
-        self.pseudoseconds = 0
+        self.instance = os.path.basename(os.path.normpath(cache_dir))
+        self.loaded = set()     # instances known to be loaded
+        self.owners = {}        # instance -> accessor, for open_ref
+        self.stamps = itertools.count(1)
         self.logger = logger
+        # last_checked files outlive the crawl instance when given a home
+        self.watermark_dir = watermark_dir
+        self.dedup = dedup
+        self.pages = {}         # (uid, request_type) -> pages stored
+        self.writer = None
+        self.manifest = None
+        self.records = None     # path -> file names, from the manifests
 
     def get_crawl_dir(self, basepath, uid, create=False):
         """
@@ -70,38 +130,268 @@ class CacheAccessor():
         """
         return self.get_crawl_dir(self.cache_dir, uid, create=create)
 
+    def get_watermark_dir(self, uid, create=False):
+        """
+        Return and create (if needed), the path of the last_checked file
+        """
+        basepath = self.watermark_dir or self.cache_dir
+        return self.get_crawl_dir(basepath, uid, create=create)
+
     def check_cache(self, uid):
         """
-        return last read tweet id if cache includes it otherwise return -1
+        return the last read tweet id of uid in a loaded instance, -1 if
+        there is none
         """
-        cache_path = self.get_cache_dir(uid, create=False)
+        marks = [tweet_id for (tweet_id, instance) in self.watermarks(uid)
+                 if instance is None or self.instance_loaded(instance)]
+        return max(marks + [-1])
+
+    def watermarks(self, uid):
+        """Return the [(tweet id, instance)] of the last_checked file of uid,
+        instance None for the mark of a loaded one"""
+        cache_path = self.get_watermark_dir(uid, create=False)
         last_checked = os.path.join(cache_path, "last_checked")
+        marks = []
         if os.path.exists(last_checked):
             with closing(open(last_checked, "r")) as fin:
-                id = int(fin.read())
-                return id
-        return -1
+                try:
+                    for line in fin.read().split("\n"):
+                        fields = line.split()
+                        if len(fields) == 1:
+                            marks.append((int(fields[0]), None))
+                        elif len(fields) == 2:
+                            marks.append((int(fields[0]), fields[1]))
+                except ValueError:
+                    self.logger.warning("corrupt watermark " + last_checked)
+        return marks
+
+    def update_watermark(self, uid, tweet_id):
+        """record tweet_id as the last read tweet of uid in this instance,
+        it counts once the instance is loaded: the tweets of an instance
+        that fails to load or is never loaded are read again"""
+        loaded = self.check_cache(uid)
+        if tweet_id <= loaded:
+            return
+        # the mark of the loaded instances, then of the ones still to load
+        lines = []
+        if loaded >= 0:
+            lines.append(str(loaded))
+        for (mark, instance) in self.watermarks(uid):
+            if (instance is not None and instance != self.instance and
+                    mark > loaded and not self.instance_loaded(instance)):
+                lines.append('%d %s' % (mark, instance))
+        lines.append('%d %s' % (tweet_id, self.instance))
+        cache_path = self.get_watermark_dir(uid, create=True)
+        last_checked = os.path.join(cache_path, "last_checked")
+        # write aside and rename so a crash never leaves half a number
+        with closing(open(last_checked + ".tmp", "w")) as fout:
+            fout.write("\n".join(lines))
+        os.rename(last_checked + ".tmp", last_checked)
 
     def store_in_cache(self, request_type, uid, data, datagzipped=False):
+        """write http data to the cache, or only a reference to the last
+        crawl if it returned the same data
+           datagzipped -  data is already gzipped"""
+        if request_type in self.dedup:
+            key = (uid, request_type)
+            page = self.pages.get(key, 0)
+            self.pages[key] = page + 1
+            if datagzipped:
+                content = gzip.GzipFile(
+                        fileobj=StringIO.StringIO(data)).read()
+            else:
+                content = data
+            digest = hashlib.sha1(content).hexdigest()
+            owner = self.update_digest(uid, request_type, page, digest)
+            if owner:
+                self.write_record(request_type + '.ref', uid,
+                                  '%s %s' % (digest, owner))
+                return
+        self.write_record(request_type, uid, data, datagzipped)
+
+    def update_digest(self, uid, request_type, page, digest):
+        """Record the digest of a page, return the instance of the previous
+        crawl if it saw the same one and is loaded, else None"""
+        cache_path = self.get_watermark_dir(uid, create=True)
+        # one file per request type, its pages are stored by one writer
+        digests_file = os.path.join(cache_path, request_type + ".digests")
+        digests = []
+        if os.path.exists(digests_file):
+            with closing(open(digests_file, "r")) as fin:
+                digests = fin.read().split("\n")
+        if page < len(digests):
+            fields = digests[page].split()
+            if (len(fields) == 2 and fields[0] == digest and
+                    self.instance_loaded(fields[1])):
+                return fields[1]
+        # this instance stores the page and owns the digest from now on
+        digests = (digests + [''] * page)[:page] + \
+                ['%s %s' % (digest, self.instance)] + digests[page + 1:]
+        with closing(open(digests_file + ".tmp", "w")) as fout:
+            fout.write("\n".join(digests))
+        os.rename(digests_file + ".tmp", digests_file)
+        return None
+
+    def forget_digest(self, uid, request_type, digest):
+        """Drop digest from the page digests of uid, the next crawl stores
+        the page again"""
+        cache_path = self.get_watermark_dir(uid)
+        digests_file = os.path.join(cache_path, request_type + ".digests")
+        if not os.path.exists(digests_file):
+            return
+        with closing(open(digests_file)) as fin:
+            digests = fin.read().split("\n")
+        # a placeholder keeps the pages after it in place
+        forgotten = [line if line.split()[:1] != [digest] else '-'
+                     for line in digests]
+        if forgotten == digests:
+            return
+        with closing(open(digests_file + ".tmp", "w")) as fout:
+            fout.write("\n".join(forgotten))
+        os.rename(digests_file + ".tmp", digests_file)
+
+    def open_ref(self, uid, request_type, ref):
+        """Open the page of uid a request_type.ref record holding ref stands
+        for, in the instance that stored it, or return None if that
+        instance is no longer in dir_cache"""
+        fields = ref.split()
+        if len(fields) != 2:
+            return None     # a ref of before they named the instance
+        (digest, instance) = fields
+        accessor = self.owners.get(instance)
+        if accessor is None:
+            path = self.instance_dir(instance)
+            if not os.path.isdir(path):
+                return None
+            accessor = get_cache_accessor(path, self.logger)
+            self.owners[instance] = accessor
+        cache_path = accessor.get_cache_dir(uid)
+        for filename in sorted(accessor.get_infiles(cache_path) or []):
+            if not filename.startswith(request_type + '.data'):
+                continue
+            filename = os.path.join(cache_path, filename)
+            sha1 = hashlib.sha1()
+            with closing(accessor.open_record(filename)) as fin:
+                for data in iter(lambda: fin.read(65536), ''):
+                    sha1.update(data)
+            if sha1.hexdigest() == digest:
+                return accessor.open_record(filename)
+        return None
+
+    def instance_dir(self, instance):
+        """Return the path of instance, next to this one in dir_cache"""
+        return os.path.join(os.path.dirname(
+                os.path.normpath(self.cache_dir)), instance)
+
+    def instance_loaded(self, instance):
+        """Return True if instance, next to this one in dir_cache, was
+        loaded: it holds the seed file load_instance copies in on success,
+        or retention compacted it since"""
+        if instance in self.loaded:
+            return True
+        path = self.instance_dir(instance)
+        loaded = os.path.exists(path + '.tar.gz')
+        if not loaded and os.path.isdir(path):
+            loaded = bool([filename for filename in os.listdir(path)
+                           if filename.startswith('seed[')])
+        if loaded:
+            self.loaded.add(instance)
+        return loaded
+
+    def write_record(self, request_type, uid, data, datagzipped=False):
         """write http data to the user specific directory
            datagzipped -  data is already gzipped"""
         #Get user specific directory of his files
         cache_path = self.get_cache_dir(uid, create=True)
         #form cache file base name
-        #we're too fast, we need more differentiation
-        self.pseudoseconds = (self.pseudoseconds + 1) % 100
-        now = timefunctions.datestamp() + (".%03d" % self.pseudoseconds)
+        now = self.next_stamp()
         cache_file = os.path.join(cache_path,
                 request_type + ".%s." + now + ".gz")
-        #write data
-        #data is already gzipped:
-        if datagzipped:
-            with closing(open(cache_file % "data", "wb")) as fout:
-                fout.write(data)
-        #data is not gzipped:
-        else:
-            with closing(gzip.open(cache_file % "data", "w")) as fout:
-                fout.write(data)
+        # never replace a record, a name clash raises
+        fd = os.open(cache_file % "data", os.O_WRONLY | os.O_CREAT |
+                     os.O_EXCL, 0o644)
+        with closing(os.fdopen(fd, "wb")) as raw:
+            #write data
+            #data is already gzipped:
+            if datagzipped:
+                raw.write(data)
+            #data is not gzipped:
+            else:
+                with closing(gzip.GzipFile(os.path.basename(
+                        cache_file % "data")[:-3], "wb", 9, raw)) as fout:
+                    fout.write(data)
+        self.add_to_manifest(uid, request_type,
+                             os.path.basename(cache_file % "data"))
+
+    def writer_id(self):
+        """Return a name no other writer of the instance uses"""
+        if self.writer is None:
+            with CacheAccessor.writers_lock:
+                writer = CacheAccessor.writers.next()
+            self.writer = '%d-%d' % (os.getpid(), writer)
+        return self.writer
+
+    def add_to_manifest(self, uid, request_type, filename):
+        if self.manifest is None:
+            manifest_dir = os.path.join(self.cache_dir,
+                                        CacheAccessor.MANIFEST_DIR)
+            if not os.path.exists(manifest_dir):
+                try:
+                    os.makedirs(manifest_dir)
+                except OSError:
+                    pass        # created by another worker meanwhile
+            self.manifest = open(os.path.join(manifest_dir,
+                                              self.writer_id() + '.txt'), 'a')
+        # the file is complete before its entry is written
+        self.manifest.write('%s\t%s\t%s\n' % (uid, request_type, filename))
+        self.manifest.flush()
+
+    def load_manifest(self):
+        """Read every manifest of the instance, return False if there are
+        none"""
+        manifest_dir = os.path.join(self.cache_dir, CacheAccessor.MANIFEST_DIR)
+        if not os.path.isdir(manifest_dir):
+            return False
+        self.records = {}
+        self.users = []         # (uid, path) in order of appearance
+        for name in sorted(os.listdir(manifest_dir)):
+            if not name.endswith('.txt'):
+                continue
+            with closing(open(os.path.join(manifest_dir, name))) as fin:
+                for line in fin:
+                    try:
+                        (uid, request_type, filename) = \
+                                line.rstrip('\n').split('\t')
+                    except ValueError:
+                        continue    # torn last line of a crashed writer
+                    path = self.get_cache_dir(uid)
+                    if path not in self.records:
+                        self.records[path] = []
+                        self.users.append((uid, path))
+                    self.records[path].append(filename)
+        return True
+
+    def next_stamp(self):
+        """Return the timestamp that tells the next record apart, the
+        writer and a count of its records follow the time so no two records
+        of an instance share one however many a second are written"""
+        return '%s.%s.%d' % (timefunctions.datestamp(), self.writer_id(),
+                             self.stamps.next())
+
+    def open_record(self, filename):
+        """Open a cached file for reading its uncompressed data"""
+        return gzip.open(filename, 'r')
+
+    def close(self):
+        if self.manifest is not None:
+            self.manifest.close()
+            self.manifest = None
+        self.close_owners()
+
+    def close_owners(self):
+        for accessor in self.owners.values():
+            accessor.close()
+        self.owners = {}
 
     def set_cache_dir(self, cache_dir):
         self.cache_dir = cache_dir
@@ -111,6 +401,8 @@ class CacheAccessor():
             return None
         if(uid and not(cache_path)):
             cache_path = self.get_cache_dir(uid)
+        if self.records is not None:
+            return list(self.records.get(cache_path, []))
         try:
             infiles = os.listdir(cache_path)
             return infiles
@@ -120,7 +412,12 @@ class CacheAccessor():
             return None
 
     def idqueue(self):
-        #go through the crawl directory and get all the crawl_id folders
+        if self.load_manifest():
+            for user in self.users:
+                yield user
+            return
+        #no manifest, go through the crawl directory and get all the
+        #crawl_id folders
         for file in os.walk(self.cache_dir):
             filename = file[0]
             pattern = re.escape(self.cache_dir) + "/\d+/\d+/\d+/(\d*)"
@@ -129,9 +426,213 @@ class CacheAccessor():
                 yield(m.group(1), filename)
 
 
+class SegmentCacheAccessor(CacheAccessor):
+    """Cache writer/reader appending records to large segment files
+
+    Instead of one gzip file per response in a directory per user, every
+    accessor appends gzipped records to its own segment files under
+    cache_dir/segments and writes one line per record to its own index,
+    uid, request type, timestamp, segment, offset and length.  Accessors
+    in different threads never share a file, so no locking is needed.
+    Readers load the indexes and mmap the segments.  To the processor a
+    user still looks like a directory of cache files: idqueue yields the
+    same paths as CacheAccessor, get_infiles lists the user's records by
+    their usual file names and open_record reads one by offset.
+    """
+    SEGMENT_DIR = 'segments'
+
+    def __init__(self, cache_dir, logger, watermark_dir=None, dedup=(),
+                 segment_size=256 * 1024 * 1024):
+        CacheAccessor.__init__(self, cache_dir, logger, watermark_dir, dedup)
+        self.segment_dir = os.path.join(cache_dir,
+                                        SegmentCacheAccessor.SEGMENT_DIR)
+        self.segment_size = segment_size
+        self.segment = None     # segment being written
+        self.index = None
+        self.records = None     # path -> (segment, offset, length)
+        self.maps = {}
+
+    def write_record(self, request_type, uid, data, datagzipped=False):
+        """append http data to the segment being written
+           datagzipped -  data is already gzipped"""
+        if not datagzipped:
+            buf = StringIO.StringIO()
+            with closing(gzip.GzipFile(fileobj=buf, mode='wb')) as fout:
+                fout.write(data)
+            data = buf.getvalue()
+        if self.segment is None or \
+                self.segment.tell() + len(data) > self.segment_size:
+            self.roll()
+        offset = self.segment.tell()
+        self.segment.write(data)
+        self.segment.flush()    # data first, the index must not lead it
+        self.index.write('%s\t%s\t%s\t%s\t%d\t%d\n' % (uid, request_type,
+                self.next_stamp(), os.path.basename(self.segment.name),
+                offset, len(data)))
+        self.index.flush()
+
+    def roll(self):
+        """Start a new segment file"""
+        if self.segment is None:
+            if not os.path.exists(self.segment_dir):
+                try:
+                    os.makedirs(self.segment_dir)
+                except OSError:
+                    pass        # created by another worker meanwhile
+            self.sequence = 0
+            self.index = open(os.path.join(self.segment_dir,
+                                           self.writer_id() + '.idx'), 'a')
+        else:
+            self.segment.close()
+        self.sequence += 1
+        segment = '%s.%d.seg' % (self.writer_id(), self.sequence)
+        self.segment = open(os.path.join(self.segment_dir, segment), 'ab')
+
+    def close(self):
+        for f in (self.segment, self.index):
+            if f is not None:
+                f.close()
+        self.segment = self.index = None
+        for m in self.maps.values():
+            m.close()
+        self.maps = {}
+        self.close_owners()
+
+    def load_index(self):
+        """Read every index of the instance, keyed by the path the record
+        would have had in a file cache.  The name ends in the segment and
+        offset of the record, so no two records share one whatever their
+        stamps"""
+        self.records = {}
+        self.users = []         # (uid, path) in order of appearance
+        if not os.path.exists(self.segment_dir):
+            return
+        for name in sorted(os.listdir(self.segment_dir)):
+            if not name.endswith('.idx'):
+                continue
+            with closing(open(os.path.join(self.segment_dir, name))) as fin:
+                for line in fin:
+                    try:
+                        (uid, request_type, stamp, segment, offset,
+                         length) = line.rstrip('\n').split('\t')
+                        record = (segment, int(offset), int(length))
+                    except ValueError:
+                        continue    # torn last line of a crashed writer
+                    path = self.get_cache_dir(uid)
+                    if path not in self.records:
+                        self.records[path] = {}
+                        self.users.append((uid, path))
+                    filename = "%s.data.%s.%s.%s.gz" % (request_type, stamp,
+                            segment[:-len('.seg')], offset)
+                    self.records[path][filename] = record
+
+    def idqueue(self):
+        if self.records is None:
+            self.load_index()
+        for user in self.users:
+            yield user
+
+    def get_infiles(self, cache_path=None, uid=None):
+        if self.records is None:
+            self.load_index()
+        if uid and not cache_path:
+            cache_path = self.get_cache_dir(uid)
+        return sorted(self.records.get(cache_path, {}).keys())
+
+    def open_record(self, filename):
+        if self.records is None:
+            self.load_index()
+        (path, name) = os.path.split(filename)
+        (segment, offset, length) = self.records[path][name]
+        if segment not in self.maps:
+            with closing(open(os.path.join(self.segment_dir, segment),
+                              'rb')) as fin:
+                self.maps[segment] = mmap.mmap(fin.fileno(), 0,
+                                               access=mmap.ACCESS_READ)
+        data = self.maps[segment][offset:offset + length]
+        return gzip.GzipFile(fileobj=StringIO.StringIO(data), mode='rb')
+
+
+def get_cache_accessor(cache_dir, logger, watermark_dir=None, config={}):
+    """Return the accessor for a cache instance, in the format of an
+    existing instance or else in the cache_format of config"""
+    segments = os.path.join(cache_dir, SegmentCacheAccessor.SEGMENT_DIR)
+    dedup = config.get('cache_dedup', [])
+    if os.path.isdir(segments) or config.get('cache_format') == 'segments':
+        return SegmentCacheAccessor(cache_dir, logger, watermark_dir, dedup,
+                config.get('cache_segment_size', 256 * 1024 * 1024))
+    return CacheAccessor(cache_dir, logger, watermark_dir, dedup)
+
+
+def iter_json_array(fin, key=None, chunk_size=65536):
+    """Yield the items of a JSON array one by one while reading fin in
+    chunks, so memory holds one item and one chunk however long the array.
+    With key, the array is the value of that key in the top level object,
+    found by the first occurrence of "key" in the text."""
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    state = {'buffer': u'', 'eof': False}
+
+    def more():
+        """Read a chunk into the buffer, return False at the end"""
+        if state['eof']:
+            return False
+        data = fin.read(chunk_size)
+        state['eof'] = not data
+        state['buffer'] += utf8.decode(data, state['eof'])
+        return True
+
+    # Find the opening bracket
+    pos = 0
+    if key is not None:
+        mark = '"%s"' % key
+        while state['buffer'].find(mark) < 0:
+            if not more():
+                raise ValueError('no "%s" in JSON data' % key)
+        pos = state['buffer'].find(mark) + len(mark)
+    while True:
+        buffer = state['buffer']
+        while pos < len(buffer) and buffer[pos] in ' \t\r\n:':
+            pos += 1
+        if pos < len(buffer):
+            break
+        if not more():
+            raise ValueError('no JSON array')
+    if state['buffer'][pos] != '[':
+        raise ValueError('expected a JSON array')
+    pos += 1
+    while True:
+        buffer = state['buffer']
+        while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+            pos += 1
+        if pos == len(buffer):
+            if not more():
+                raise ValueError('unterminated JSON array')
+            continue
+        if buffer[pos] == ']':
+            return
+        try:
+            (item, end) = decoder.raw_decode(buffer, pos)
+        except ValueError:
+            if not more():
+                raise
+            continue
+        if (buffer[pos] in '-0123456789' and
+                (end == len(buffer) or buffer[end] in '.eE+-0123456789') and
+                more()):
+            continue    # a number may go on in the next chunk, 1. of 1.5
+        yield item
+        pos = end
+        if pos > chunk_size:
+            state['buffer'] = state['buffer'][pos:]
+            pos = 0
+
+
 class mysql_db():
     """Connector class for MySQL database"""
     def __init__(self, host, user, password, db, logger):
+        # only MySQL deployments need the driver
+        import MySQLdb
         try:
             self.conn = MySQLdb.connect(host, user, password, db)
             self.cursor = self.conn.cursor()
@@ -161,36 +662,326 @@ class mysql_db():
         except Exception as e:
             self.logger.error("MySQL execute error: %s\nSTMT: %s" % (e, stmt))
 
+    def executemany(self, stmt, rows):
+        """Run stmt, with %s placeholders, for every row"""
+        try:
+            self.cursor.executemany(stmt, rows)
+            self.conn.commit()
+        except Exception as e:
+            self.logger.error("MySQL executemany error: %s\nSTMT: %s" %
+                              (e, stmt))
+
+    def load(self, table, filename):
+        """Bulk load a file in the format of file_db into table"""
+        self.execute('LOAD DATA LOCAL INFILE "%s" INTO TABLE %s FIELDS '
+                     'TERMINATED BY "\\t" LINES TERMINATED BY "\\n"' %
+                     (filename, table))
+
+    def __del__(self):
+        self.conn.close()
+
+
+class sqlite_db():
+    """Connector class for an SQLite database file, the same interface as
+    mysql_db with ? placeholders
+
+    A new file gets the tables of scripts/twaler_schema.sql.  The database
+    runs in WAL mode so readers like the generator go on while the loader
+    writes, statements commit on their own unless between BEGIN and
+    COMMIT, and executemany and load commit once for all their rows.
+    Upserts need SQLite 3.24, insert with updates 3.35.
+    """
+    SCHEMA = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          os.pardir, 'scripts', 'twaler_schema.sql')
+
+    def __init__(self, path, logger, schema=SCHEMA):
+        self.logger = logger
+        try:
+            self.conn = sqlite3.connect(path, timeout=60,
+                                        isolation_level=None,
+                                        check_same_thread=False)
+            self.cursor = self.conn.cursor()
+            mode = self.conn.execute('PRAGMA journal_mode=WAL').fetchone()[0]
+            if mode != 'wal':
+                self.logger.warning('SQLite journal mode is %s, not wal' %
+                                    mode)
+            # durable at checkpoints, enough in WAL mode
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.create(schema)
+            self.logger.debug("Opened SQLite database " + path)
+        except Exception as e:
+            self.logger.error("SQLite open error: " + str(e))
+
+    @staticmethod
+    def translate(sql):
+        """Return the statements of a MySQL schema in SQLite"""
+        stmts = []
+        for stmt in sql.split(';'):
+            stmt = '\n'.join([line for line in stmt.split('\n')
+                              if not line.strip().startswith('--')]).strip()
+            match = re.match(r'CREATE TABLE (\w+)', stmt)
+            if not match:
+                continue
+            table = match.group(1)
+            indexes = re.findall(r',\s*INDEX\s*\(([^)]*)\)', stmt)
+            stmt = re.sub(r',\s*INDEX\s*\([^)]*\)', '', stmt)
+            stmt = stmt.replace(' UNSIGNED', '')
+            # a rowid alias, ids fit in its 63 bits
+            stmt = stmt.replace('BIGINT PRIMARY KEY', 'INTEGER PRIMARY KEY')
+            stmts.append(stmt)
+            for columns in indexes:
+                name = '_'.join([table] + re.findall(r'\w+', columns))
+                stmts.append('CREATE INDEX %s ON %s (%s)' %
+                             (name, table, columns))
+        return stmts
+
+    def create(self, schema):
+        """Create the tables of schema in an empty database"""
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            tables = self.conn.execute("SELECT count(*) FROM sqlite_master "
+                                       "WHERE type = 'table'").fetchone()[0]
+            if not tables:
+                with closing(open(schema)) as fin:
+                    for stmt in sqlite_db.translate(fin.read()):
+                        self.conn.execute(stmt)
+                self.logger.info("Created SQLite tables from " + schema)
+            self.conn.execute('COMMIT')
+        except:
+            self.conn.execute('ROLLBACK')
+            raise
+
+    def insert(self, table, values, updates=None):
+        try:
+            stmt = "INSERT INTO %s VALUES(%s)" % (table,
+                                                 ",".join("?" * len(values)))
+            if updates:
+                stmt += " ON CONFLICT DO UPDATE SET " + ",".join(
+                        ["%s='%s'" % (key, updates[key]) for key in updates])
+            self.cursor.execute(stmt, values)
+        except Exception as e:
+            self.logger.error("SQLite insert error: %s\nSTMT: %s" % (e, stmt))
+
+    def execute(self, stmt, values=()):
+        try:
+            self.cursor.execute(stmt, values)
+        except Exception as e:
+            self.logger.error("SQLite execute error: %s\nSTMT: %s" %
+                              (e, stmt))
+
+    def executemany(self, stmt, rows):
+        """Run stmt, with ? placeholders, for every row"""
+        try:
+            self.cursor.execute('BEGIN IMMEDIATE')
+            try:
+                self.cursor.executemany(stmt, rows)
+                self.cursor.execute('COMMIT')
+            except:
+                self.cursor.execute('ROLLBACK')
+                raise
+        except Exception as e:
+            self.logger.error("SQLite executemany error: %s\nSTMT: %s" %
+                              (e, stmt))
+
+    def columns(self, table):
+        return [row[1] for row in
+                self.conn.execute('PRAGMA table_info(%s)' % table)]
+
+    def load(self, table, filename):
+        """Bulk load a file in the format of file_db into table"""
+        marks = ",".join("?" * len(self.columns(table)))
+        self.executemany("INSERT INTO %s VALUES(%s)" % (table, marks),
+                         file_db.read_rows(filename))
+
     def __del__(self):
         self.conn.close()
 
 
+def connect_db(config, logger):
+    """Return a connector to the database named by db_backend in config,
+    mysql or sqlite"""
+    if config.get('db_backend', 'mysql') == 'sqlite':
+        return sqlite_db(config.get('db_sqlite', 'twaler.db'), logger)
+    return mysql_db(config['db_server'], config['db_username'],
+                    config['db_password'], config['db_database'], logger)
+
+
+class mysql_pool():
+    """Pool of MySQL connections for threads to take turns on, opened on
+    demand with LOAD DATA LOCAL enabled and checked before reuse"""
+    def __init__(self, host, user, password, db, logger, size=4):
+        self.args = (host, user, password, db)
+        self.logger = logger
+        self.slots = threading.Semaphore(size)
+        self.lock = threading.Lock()
+        self.idle = []
+
+    def connect(self):
+        import MySQLdb
+        (host, user, password, db) = self.args
+        conn = MySQLdb.connect(host=host, user=user, passwd=password, db=db,
+                               local_infile=1, charset='utf8')
+        conn.autocommit(False)
+        self.logger.debug("Connected to MySQL as " + user)
+        return conn
+
+    def checkout(self):
+        import MySQLdb
+        self.slots.acquire()
+        try:
+            with self.lock:
+                conn = None
+                if self.idle:
+                    conn = self.idle.pop()
+            if conn is not None:
+                try:
+                    conn.ping()
+                    return conn
+                except MySQLdb.Error:
+                    self.logger.warning("MySQL connection lost, reconnecting")
+            return self.connect()
+        except:
+            self.slots.release()
+            raise
+
+    def checkin(self, conn, broken=False):
+        import MySQLdb
+        if broken:
+            try:
+                conn.close()
+            except MySQLdb.Error:
+                pass
+        else:
+            with self.lock:
+                self.idle.append(conn)
+        self.slots.release()
+
+    def close(self):
+        with self.lock:
+            for conn in self.idle:
+                conn.close()
+            self.idle = []
+
+
 class file_db():
     """Class to write to file"""
-    """Opens a table of filestreams and writes to them until close"""
-    def __init__(self, dir_file, logger):
+    """Opens a table of files and writes rows to them until close
+
+    Rows are written in the text format LOAD DATA INFILE reads by default:
+    tab separated, backslash escaped, NULL as \\N, utf-8.  Every table goes
+    through a large write buffer, and with compress to <table>.tsv.gz,
+    which the loader decompresses before loading.
+    """
+    ESCAPES = [('\\', '\\\\'), ('\t', '\\t'), ('\n', '\\n'),
+               ('\r', '\\r'), ('\0', '\\0')]
+
+    def __init__(self, dir_file, logger, compress=False,
+                 buffer_size=1024 * 1024, append=False):
         try:
             self.dir_file = dir_file
             self.logger = logger
             self.logger.debug("Writing output files to directory " +
                     self.dir_file)
+            self.mode = "wb"
+            if append:
+                self.mode = "ab"
+            self.compress = compress
+            self.buffer_size = buffer_size
             self.fileStream = {}
+            self.files = []
         except Exception as e:
-            self.logger.erro("File Error:"+ str(e))
+            self.logger.error("File Error:"+ str(e))
+
+    SPECIAL = re.compile('[\\\\\t\n\r\0]')
+
+    @staticmethod
+    def escape(value):
+        """Return value as a LOAD DATA field"""
+        kind = type(value)
+        if kind is int or kind is long:
+            return str(value)
+        if kind is unicode:
+            value = value.encode('utf-8')
+        elif value is None:
+            return '\\N'
+        elif kind is not str:
+            return str(value)
+        if file_db.SPECIAL.search(value):
+            for (char, escaped) in file_db.ESCAPES:
+                value = value.replace(char, escaped)
+        return value
+
+    UNESCAPES = {'\\': '\\', 't': '\t', 'n': '\n', 'r': '\r', '0': '\0'}
+    ESCAPED = re.compile(r'\\(.)')
+
+    @staticmethod
+    def unescape(field):
+        """Return the value of a LOAD DATA field, text as unicode"""
+        if field == '\\N':
+            return None
+        if '\\' in field:
+            field = file_db.ESCAPED.sub(
+                    lambda m: file_db.UNESCAPES.get(m.group(1), m.group(1)),
+                    field)
+        return field.decode('utf-8')
+
+    @staticmethod
+    def read_rows(filename):
+        """Yield the rows of a table written by file_db"""
+        with closing(open(filename, 'rb')) as fin:
+            for line in fin:
+                yield [file_db.unescape(field)
+                       for field in line.rstrip('\n').split('\t')]
+
+    def stream(self, table):
+        if table not in self.fileStream:
+            filename = os.path.join(self.dir_file, table + ".tsv")
+            if self.compress:
+                filename += ".gz"
+            fout = open(filename, self.mode, self.buffer_size)
+            self.files.append(fout)
+            if self.compress:
+                # level 1, the point is less disk traffic not less disk
+                fout = gzip.GzipFile(table + ".tsv", "wb", 1, fout)
+            self.fileStream[table] = fout
+        return self.fileStream[table]
 
     def insert(self, table, values, updates=None):
         try:
-            if table not in self.fileStream:
-                self.fileStream[table] = codecs.open(
-                        os.path.join(self.dir_file, table+".tsv"), "w",
-                        encoding='utf-8')
-            print(*values, sep='\t', end='\n', file=self.fileStream[table])
+            self.stream(table).write(
+                    '\t'.join(map(file_db.escape, values)) + '\n')
+        except Exception as e:
+            self.logger.error("File write error:"+ str(e))
+
+    def insert_many(self, table, rows):
+        """Write a batch of rows with one write"""
+        if not rows:
+            return
+        try:
+            escape = file_db.escape
+            self.stream(table).write('\n'.join([
+                    '\t'.join(map(escape, values)) for values in rows]) + '\n')
         except Exception as e:
             self.logger.error("File write error:"+ str(e))
 
     def __del__(self):
         for table in self.fileStream:
             self.fileStream[table].close()
+        for fout in self.files:
+            fout.close()        # GzipFile leaves the file open
+        self.fileStream = {}
+        self.files = []
+
+    def sync(self):
+        """Close the tables, durably, later rows are appended to them"""
+        if self.compress:
+            for table in self.fileStream:
+                self.fileStream[table].close()  # ends the gzip member
+        for fout in self.files:
+            fout.flush()
+            os.fsync(fout.fileno())
+        self.__del__()
+        self.mode = "ab"
 
     def execute(self, stmt):
         return None
@@ -200,7 +991,8 @@ def write_to_files(seeds, file_prefix, id_per_file, seedtype='utf'):
     '''
     Dump a list of seeds into directory, started by file_prefix every
     file contains id_per_file ids, individual files are numbered by
-    numbers, starting from zero
+    numbers, starting from zero.  A second column in seeds is written
+    out as the crawl priority of the seed
     '''
     suffix = cnt = 0
     seed_dir = 'seeds'      # N.B. need change?
@@ -214,6 +1006,65 @@ def write_to_files(seeds, file_prefix, id_per_file, seedtype='utf'):
             name = '%s_%s.txt' % (file_prefix, suffix)
             fp = open(os.path.join(seed_dir, name), 'w')
             cnt = 0
-        fp.write('%s\t%s\n' % (seedtype, user[0]))
+        if len(user) > 1:
+            fp.write('%s\t%s\t%s\n' % (seedtype, user[0], user[1]))
+        else:
+            fp.write('%s\t%s\n' % (seedtype, user[0]))
         cnt += 1
     fp.close()
+
+
+def main():
+    """Self-check: iter_json_array against json.loads on random arrays,
+    read in chunks of 1 to 8 bytes"""
+    import sys
+    import random
+
+    cases = 3000
+    if len(sys.argv) > 1:
+        cases = int(sys.argv[1])
+    random.seed(cases)
+
+    def value(depth):
+        kind = random.randint(0, depth < 2 and 5 or 3)
+        if kind == 0:
+            return random.randint(-10 ** 6, 10 ** 6)
+        if kind == 1:
+            return random.uniform(-1, 1) * 10 ** random.randint(-30, 30)
+        if kind == 2:
+            return random.choice([u'', u'a', u'\xe4 "q"', u'x\\y'])
+        if kind == 3:
+            return random.choice([True, False, None, 0, -0.5])
+        if kind == 4:
+            return [value(depth + 1) for i in range(random.randint(0, 3))]
+        return dict([('k%d' % i, value(depth + 1))
+                     for i in range(random.randint(0, 3))])
+
+    failed = 0
+    for case in range(cases):
+        items = [value(0) for i in range(random.randint(0, 6))]
+        key = random.choice([None, 'ids'])
+        if key:
+            data = json.dumps({key: items, 'next_cursor': 0})
+        else:
+            data = json.dumps(items)
+        chunk_size = random.randint(1, 8)
+        expected = json.loads(data)
+        if key:
+            expected = expected[key]
+        try:
+            got = list(iter_json_array(StringIO.StringIO(data.encode('utf-8')),
+                                       key, chunk_size))
+        except ValueError as e:
+            got = e
+        if got != expected:
+            failed += 1
+            if failed <= 10:
+                print('chunks of %d: %s gave %r' % (chunk_size, data, got))
+    print('%d cases, %d failed' % (cases, failed))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+#!/usr/bin/python2.6
+from __future__ import with_statement
+import sys
+import time
+import gzip
+import json
+import math
+import random
+import urlparse
+import StringIO
+import optparse
+import threading
+import SocketServer
+import BaseHTTPServer
+
+
+class MockApi(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Local stand-in for the Twitter API endpoints the crawler uses
+
+    Serves users/show, users/lookup, friends/ids with cursors,
+    statuses/user_timeline with since_id/max_id and rate_limit_status.
+    Users are made up from their id, so every run sees the same data:
+    user uid follows uid % friends users and posted uid % tweets tweets.
+    Latency, error rate, gzip behaviour and the rate limit are settings.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 1024
+
+    def __init__(self, port=8080, latency=0.05, error_rate=0.0,
+                 gzip_mode='auto', limit=0, window=3600, friends=1000,
+                 friends_page=5000, tweets=400):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port),
+                                           _MockHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.gzip_mode = gzip_mode      # auto, always or never
+        self.limit = limit              # requests per window, 0 unlimited
+        self.window = window
+        self.friends = friends
+        self.friends_page = friends_page
+        self.tweets = tweets
+        self.lock = threading.Lock()
+        self.window_start = time.time()
+        self.used = 0
+        self.requests = 0
+        self.bytes = 0
+        self.codes = {}
+
+    def start(self):
+        """Serve on a daemon thread, return the API base url"""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        return 'http://127.0.0.1:%d/1' % self.server_address[1]
+
+    def status_url(self):
+        return ('http://127.0.0.1:%d/account/rate_limit_status.json' %
+                self.server_address[1])
+
+    def take(self):
+        """Count a request against the rate limit, return
+        (allowed, remaining, reset time)"""
+        with self.lock:
+            now = time.time()
+            if now >= self.window_start + self.window:
+                self.window_start = now
+                self.used = 0
+            reset = int(math.ceil(self.window_start + self.window))
+            if not self.limit:
+                return (True, 1000000, reset)
+            if self.used >= self.limit:
+                return (False, 0, reset)
+            self.used += 1
+            return (True, self.limit - self.used, reset)
+
+    def count(self, code, nbytes):
+        with self.lock:
+            self.requests += 1
+            self.bytes += nbytes
+            self.codes[code] = self.codes.get(code, 0) + 1
+
+    def report(self):
+        with self.lock:
+            codes = ', '.join(['%s: %d' % item
+                               for item in sorted(self.codes.items())])
+            return ('mock API served %d requests, %.1f KB (%s)' %
+                    (self.requests, self.bytes / 1024.0, codes))
+
+    # Made up data
+    #---------------
+    def user(self, uid):
+        return {'id': uid, 'id_str': str(uid),
+                'name': 'User %d' % uid, 'screen_name': 'user%d' % uid,
+                'location': 'Pittsburgh, PA',
+                'description': 'Made up user number %d' % uid,
+                'url': None, 'followers_count': uid % 7919,
+                'friends_count': uid % self.friends,
+                'statuses_count': uid % self.tweets,
+                'created_at': 'Wed Aug 27 13:08:45 +0000 2008'}
+
+    def friend_ids(self, uid, page):
+        first = page * self.friends_page
+        last = min(uid % self.friends, first + self.friends_page)
+        return [(uid * 7919 + i * 104729) % 1000000007
+                for i in xrange(first, last)]
+
+    def tweet(self, uid, tid):
+        other = (tid * 31) % 1000000007
+        return {'id': tid, 'id_str': str(tid), 'user': {'id': uid},
+                'created_at': time.strftime('%a %b %d %H:%M:%S +0000 %Y',
+                                            time.gmtime(tid % 1300000000)),
+                'text': 'tweet %d about #topic%d http://t.co/%d @user%d' %
+                        (tid, tid % 10, tid, other),
+                'retweet_count': tid % 5,
+                'entities': {
+                    'hashtags': [{'text': 'topic%d' % (tid % 10)}],
+                    'urls': [{'url': 'http://t.co/%d' % tid}],
+                    'user_mentions': [{'id': other}]}}
+
+    def timeline(self, uid, count, since_id, max_id):
+        # tweet ids of a user are uid * 10000 + 1 .. uid * 10000 + n
+        newest = uid * 10000 + uid % self.tweets
+        if max_id:
+            newest = min(newest, max_id)
+        oldest = max(uid * 10000, since_id or 0)
+        return [self.tweet(uid, tid)
+                for tid in xrange(newest, max(oldest, newest - count), -1)]
+
+
+class _MockHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'   # keep-alive
+    wbufsize = 65536                # one packet per response
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse.urlsplit(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        time.sleep(server.latency * random.uniform(0.5, 1.5))
+        if url.path.endswith('rate_limit_status.json'):
+            (allowed, remaining, reset) = server.take()
+            if server.limit:
+                remaining += 1      # the probe itself is free
+            return self.reply(200, {'remaining_hits': remaining,
+                                    'reset_time_in_seconds': reset,
+                                    'hourly_limit': server.limit or 1000000})
+        (allowed, remaining, reset) = server.take()
+        headers = {'X-RateLimit-Remaining': remaining,
+                   'X-RateLimit-Reset': reset,
+                   'X-RateLimit-Limit': server.limit or 1000000}
+        if not allowed:
+            return self.reply(400, {'error': 'Rate limit exceeded'}, headers)
+        if random.random() < server.error_rate:
+            return self.reply(random.choice((500, 502, 503)),
+                              {'error': 'Over capacity'}, headers)
+        try:
+            if url.path.endswith('/users/show.json'):
+                data = server.user(int(query['user_id']))
+            elif url.path.endswith('/users/lookup.json'):
+                data = [server.user(int(uid))
+                        for uid in query['user_id'].split(',')]
+            elif url.path.endswith('/friends/ids.json'):
+                uid = int(query['user_id'])
+                page = max(0, int(query.get('cursor', -1)))
+                next_cursor = page + 1
+                if next_cursor * server.friends_page >= uid % server.friends:
+                    next_cursor = 0
+                data = {'ids': server.friend_ids(uid, page),
+                        'next_cursor': next_cursor,
+                        'previous_cursor': -page}
+            elif url.path.endswith('/statuses/user_timeline.json'):
+                data = server.timeline(int(query['user_id']),
+                                       int(query.get('count', 20)),
+                                       int(query.get('since_id', 0)),
+                                       int(query.get('max_id', 0)))
+            else:
+                return self.reply(404, {'error': 'Not found'}, headers)
+        except (KeyError, ValueError):
+            return self.reply(400, {'error': 'Bad request'}, headers)
+        self.reply(200, data, headers)
+
+    def reply(self, code, data, headers={}):
+        body = json.dumps(data)
+        accepts = 'gzip' in (self.headers.get('Accept-encoding') or '')
+        mode = self.server.gzip_mode
+        gzipped = mode == 'always' or (mode == 'auto' and accepts)
+        if gzipped:
+            out = StringIO.StringIO()
+            fout = gzip.GzipFile(fileobj=out, mode='wb')
+            fout.write(body)
+            fout.close()
+            body = out.getvalue()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if gzipped:
+            self.send_header('Content-Encoding', 'gzip')
+        for name in headers:
+            self.send_header(name, str(headers[name]))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.count(code, len(body))
+
+
+def options():
+    parser = optparse.OptionParser()
+    parser.add_option('--port', type='int', default=8080)
+    parser.add_option('--latency', type='float', default=0.05,
+                      help='mean seconds per response')
+    parser.add_option('--error-rate', type='float', default=0.0,
+                      help='fraction of requests failing with a 5xx')
+    parser.add_option('--gzip', default='auto',
+                      choices=('auto', 'always', 'never'))
+    parser.add_option('--limit', type='int', default=0,
+                      help='requests per window, 0 for no limit')
+    parser.add_option('--window', type='int', default=3600,
+                      help='rate limit window in seconds')
+    parser.add_option('--friends', type='int', default=1000,
+                      help='user uid follows uid %% FRIENDS users')
+    parser.add_option('--friends-page', type='int', default=5000)
+    parser.add_option('--tweets', type='int', default=400,
+                      help='user uid posted uid %% TWEETS tweets')
+    return parser
+
+
+def create(opts):
+    return MockApi(opts.port, opts.latency, opts.error_rate, opts.gzip,
+                   opts.limit, opts.window, opts.friends, opts.friends_page,
+                   opts.tweets)
+
+
+def main():
+    (opts, args) = options().parse_args()
+    server = create(opts)
+    print('Serving mock API at %s' % server.start())
+    print('Point crawl_api_base at it, crawl_status_url at %s' %
+          server.status_url())
+    try:
+        while True:
+            time.sleep(60)
+            print(server.report())
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
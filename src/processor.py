@@ -4,61 +4,208 @@ import os
 import sys
 import gzip
 import json
+import shutil
+import hashlib
 import logging
+import optparse
+import multiprocessing
 from contextlib import closing
 
 import misc
 
 class Processor():
+    """Parses crawled cache instances into TSV tables for the loader
+
+    With process_friends_delta the friends of a user are diffed against
+    the pages of the last crawl, kept in dir_watermarks next to the page
+    digests of the crawler: friends.tsv only gets the edges added,
+    unfollows.tsv the ones removed, and a friends_touch row moves date_last
+    of the rest in the database.  Users without pages of the last crawl get
+    all their edges as before.
+
+    Without it, a user whose friends pages are all .ref records, the same
+    as last crawl, gets a friends_touch row.  If only some pages changed,
+    the friends of the last crawl are not all still there: the unchanged
+    pages are read out of the instances that stored them and friends.tsv
+    gets the whole list.  process_expand_refs always reads them, so every
+    instance yields whole lists.
+    """
     def __init__(self, config, logger):
         self.config = config
         self.logger = logger
+        self.friends_delta = self.config.get('process_friends_delta', 0)
+        self.expand_refs = self.config.get('process_expand_refs', 0)
 
-    def process(self, instance, cache_dir):
+    def process(self, instance, cache_dir, resume=False, dir_processed=None):
+        """Process the cache instance into processed_crawl, or dir_processed
+        if given, with resume only the files not processed by earlier runs"""
         self.instance = misc.timefunctions.instanceToSqlTime(instance)
-        self.cache_accessor = misc.CacheAccessor(cache_dir, self.logger)
-        dir_processed = os.path.join(cache_dir, 'processed_crawl')
+        self.cache_accessor = misc.get_cache_accessor(cache_dir, self.logger,
+                self.config.get('dir_watermarks'))
+        if dir_processed is None:
+            dir_processed = os.path.join(cache_dir, 'processed_crawl')
         if not os.path.exists(dir_processed):
             os.makedirs(dir_processed)
-        self.db = misc.file_db(dir_processed, self.logger)
+        workers = self.config.get('process_workers', 1)
+        if workers > 1:
+            self.process_parallel(instance, cache_dir, dir_processed, workers,
+                                  resume)
+            self.cache_accessor.close()
+            return
         # Go through every single id under the cache folder
-        for ids in self.cache_accessor.idqueue():
-            try:
-                update_userinfo = ''
-                update_friends = ''
-                update_tweets = ''
-
-                nid = ids[0]
-                dirpath = ids[1]
-                files = os.listdir(dirpath)
-
-                for filename in files:
-                    filepath = os.path.join(dirpath, filename)
-                    if filename.startswith('userinfo.json.data'):
-                        self.store_userinfo(nid, filepath)
-                        update_userinfo = self.instance
-                    if filename.startswith('friends.json.data'):
-                        self.store_friends(nid, filepath)
-                        update_friends = self.instance
-                    if filename.startswith('tweets.json.data'):
-                        self.store_tweets(nid, filepath)
-                        update_tweets = self.instance
-                self.db.insert('users_update', (
-                    nid,
-                    update_userinfo,
-                    update_tweets,
-                    update_friends))
-            except Exception as e:
-                self.logger.error('Error during processing user %s : %s' %
-                        (nid, e))
-        self.db.__del__()
+        users = ((nid, dirpath, self.cache_accessor.get_infiles(dirpath))
+                 for (nid, dirpath) in self.cache_accessor.idqueue())
+        self.process_users(users, dir_processed, resume)
+        self.cache_accessor.close()
         self.logger.debug('processing complete')
 
+    def process_users(self, users, dir_out, resume=False):
+        """Process (nid, dirpath, files) of users into the tables of
+        dir_out, checkpointing every process_checkpoint users"""
+        checkpoint = _Checkpoint(dir_out, resume)
+        self.db = misc.file_db(dir_out, self.logger,
+                               self.config.get('process_compress', 0),
+                               append=resume)
+        every = self.config.get('process_checkpoint', 1000)
+        skipped = 0
+        for (nid, dirpath, files) in users:
+            files = checkpoint.todo(nid, files)
+            if not files:
+                skipped += 1
+                continue
+            self.process_user(nid, dirpath, files)
+            checkpoint.add(nid, files)
+            if len(checkpoint.pending) >= every:
+                self.db.sync()
+                checkpoint.commit()
+        self.db.sync()
+        checkpoint.commit()
+        if skipped:
+            self.logger.info('%d users already processed in %s' %
+                             (skipped, dir_out))
+
+    def process_parallel(self, instance, cache_dir, dir_processed, workers,
+                         resume=False):
+        """Process users in a pool of worker processes
+
+        The users are cut into runs of consecutive users in idqueue order,
+        every run is processed by a worker into its own directory of TSV
+        shards, and the shards are concatenated in run order, so the tables
+        come out the same as with a single process.  Workers checkpoint
+        their shards, on resume the shards of the same runs go on.
+        """
+        checkpoint = _Checkpoint(dir_processed, resume)
+        users = []
+        for (nid, dirpath) in self.cache_accessor.idqueue():
+            files = checkpoint.todo(nid,
+                                    self.cache_accessor.get_infiles(dirpath))
+            if files:
+                users.append((nid, dirpath, files))
+        if not users:
+            self.logger.info('every user already processed in ' +
+                             dir_processed)
+            return
+        # a few runs per worker evens out runs of heavy users
+        runs = workers * 4
+        size = max(1, (len(users) + runs - 1) // runs)
+        dir_shards = os.path.join(dir_processed, 'shards')
+        plan = '%d users in runs of %d\n' % (len(users), size)
+        plan_file = os.path.join(dir_shards, 'plan')
+        if not (resume and os.path.exists(plan_file) and
+                open(plan_file).read() == plan):
+            shutil.rmtree(dir_shards, True)     # other runs, start over
+            os.makedirs(dir_shards)
+            with closing(open(plan_file, 'w')) as fout:
+                fout.write(plan)
+        shards = []
+        for (shard, first) in enumerate(range(0, len(users), size)):
+            shards.append((self.config, instance, cache_dir,
+                           os.path.join(dir_shards, '%04d' % shard),
+                           users[first:first + size]))
+        pool = multiprocessing.Pool(workers)
+        try:
+            pool.map(_process_shard, shards)
+        finally:
+            pool.close()
+            pool.join()
+        # append the shards of every table in order
+        tables = set()
+        for shard in shards:
+            tables.update(_Checkpoint.tables(shard[3]))
+        for table in sorted(tables):
+            with closing(open(os.path.join(dir_processed, table), 'ab')) \
+                    as fout:
+                for shard in shards:
+                    path = os.path.join(shard[3], table)
+                    if os.path.exists(path):
+                        with closing(open(path, 'rb')) as fin:
+                            shutil.copyfileobj(fin, fout)
+                fout.flush()
+                os.fsync(fout.fileno())
+        for (nid, dirpath, files) in users:
+            checkpoint.add(nid, files)
+        checkpoint.commit()
+        shutil.rmtree(dir_shards, True)
+        self.logger.debug('processing complete, %d users in %d shards' %
+                          (len(users), len(shards)))
+
+    def process_user(self, nid, dirpath, files):
+        """Parse the cached files of one user"""
+        try:
+            update_userinfo = ''
+            update_friends = ''
+            update_tweets = ''
+            touch_friends = False
+            friend_pages = []
+            friend_refs = []
+            friends_changed = False
+
+            for filename in files:
+                filepath = os.path.join(dirpath, filename)
+                if filename.startswith('userinfo.json.data'):
+                    self.store_userinfo(nid, filepath)
+                    update_userinfo = self.instance
+                if filename.startswith('friends.json.') and self.friends_delta:
+                    friend_pages.append(filepath)
+                    update_friends = self.instance
+                    continue
+                if filename.startswith('friends.json.data'):
+                    self.store_friends(nid, filepath)
+                    update_friends = self.instance
+                    friends_changed = True
+                if filename.startswith('tweets.json.data'):
+                    self.store_tweets(nid, filepath)
+                    update_tweets = self.instance
+                # Same data as the last crawl, nothing to parse
+                if filename.startswith('userinfo.json.ref'):
+                    update_userinfo = self.instance
+                if filename.startswith('friends.json.ref'):
+                    friend_refs.append(filepath)
+                    update_friends = self.instance
+            if friend_pages:
+                touch_friends = self.store_friends_delta(nid, friend_pages)
+            elif friend_refs:
+                touch_friends = self.store_friend_refs(nid, friend_refs,
+                                                       friends_changed)
+            if touch_friends:
+                # the friends seen last time are still there
+                self.db.insert('friends_touch', (
+                    nid,
+                    self.instance))
+            self.db.insert('users_update', (
+                nid,
+                update_userinfo,
+                update_tweets,
+                update_friends))
+        except Exception as e:
+            self.logger.error('Error during processing user %s : %s' %
+                    (nid, e))
+
     def store_userinfo(self, nid, filename):
         '''put them in cache'''
         self.logger.debug('processing ' + filename)
         # Open up downloaded file for reading
-        with closing(gzip.open(filename, 'r')) as fin:
+        with closing(self.cache_accessor.open_record(filename)) as fin:
             try:
                 data = json.loads(fin.read().decode())
                 url = data['url']
@@ -80,60 +227,352 @@ class Processor():
 
     def store_tweets(self, nid, filename):
         self.logger.debug('processing ' + filename)
+        batch = self.config.get('process_batch_size', 5000)
+        # Columns of the tweets parsed and not yet written
+        columns = {'tid': [], 'retweets': [], 'created': [], 'text': [],
+                   'hashtags': [], 'urls': [], 'mentions': []}
         # Open up downloaded file for reading
-        with closing(gzip.open(filename, 'r')) as fin:
+        with closing(self.cache_accessor.open_record(filename)) as fin:
             try:
-                data = json.loads(fin.read().decode())
-                for t in data:
+                # one tweet at a time, a page of tweets may be large
+                for t in misc.iter_json_array(fin):
                     tid = t['id']
-                    self.db.insert('tweets', (
-                        tid,
-                        nid,
-                        t['retweet_count'],
-                        misc.timefunctions.jsonToSqlTime(t['created_at']),
-                        t['text']))
-                    for h in t['entities']['hashtags']:
-                        self.db.insert('hashtags', (
-                            tid,
-                            h['text']))
-                    for u in t['entities']['urls']:
-                        self.db.insert('urls', (
-                            tid,
-                            u['url']))
-                    for m in t['entities']['user_mentions']:
-                        self.db.insert('mentions', (
-                            tid,
-                            m['id']))
+                    entities = t['entities']
+                    hashtags = [(tid, h['text'])
+                                for h in entities['hashtags']]
+                    urls = [(tid, u['url']) for u in entities['urls']]
+                    mentions = [(tid, m['id'])
+                                for m in entities['user_mentions']]
+                    columns['tid'].append(tid)
+                    columns['retweets'].append(t['retweet_count'])
+                    columns['created'].append(t['created_at'])
+                    columns['text'].append(t['text'])
+                    columns['hashtags'].extend(hashtags)
+                    columns['urls'].extend(urls)
+                    columns['mentions'].extend(mentions)
+                    if len(columns['tid']) >= batch:
+                        self.flush_tweets(nid, columns)
             except Exception as e:
                 self.logger.error("Can't parse tweets, error: " + str(e))
+            try:
+                self.flush_tweets(nid, columns)
+            except Exception as e:
+                self.logger.error("Can't store tweets, error: " + str(e))
+
+    def flush_tweets(self, nid, columns):
+        """Write a batch of tweet columns, a table at a time"""
+        created = misc.timefunctions.jsonToSqlTimes(columns['created'])
+        self.db.insert_many('tweets', zip(columns['tid'],
+                                          [nid] * len(columns['tid']),
+                                          columns['retweets'], created,
+                                          columns['text']))
+        for table in ('hashtags', 'urls', 'mentions'):
+            self.db.insert_many(table, columns[table])
+        for column in columns.values():
+            del column[:]
 
     def store_friends(self, nid, filename):
         self.logger.debug('processing ' + filename)
         # Open up downloaded file for reading
-        with closing(gzip.open(filename, 'r')) as fin:
-            try:
-                data = json.loads(fin.read().decode())
-                ids = data['ids']
-                for fid in ids:
-                    self.db.insert('friends', (
-                        nid,
-                        fid,
-                        self.instance,
-                        self.instance))
-            except Exception as e:
-                self.logger.error(
-                        "Can't process friends info, error: " + str(e))
+        with closing(self.cache_accessor.open_record(filename)) as fin:
+            self.read_friends(nid, fin)
+
+    def read_friends(self, nid, fin):
+        batch = self.config.get('process_batch_size', 5000)
+        fids = []
+        try:
+            # one id at a time, heavy users have long pages
+            for fid in misc.iter_json_array(fin, 'ids'):
+                fids.append(fid)
+                if len(fids) >= batch:
+                    self.flush_friends(nid, fids)
+        except Exception as e:
+            self.logger.error(
+                    "Can't process friends info, error: " + str(e))
+        self.flush_friends(nid, fids)
+
+    def store_friend_refs(self, nid, filenames, changed):
+        """Store the friends on the pages the friends.json.ref records of
+        filenames stand for, or return True if a touch does instead: no
+        page of the user changed and process_expand_refs is off"""
+        if not changed and not self.expand_refs:
+            return True
+        for filename in filenames:
+            self.logger.debug('processing ' + filename)
+            with closing(self.cache_accessor.open_record(filename)) as fin:
+                ref = fin.read()
+            page = self.cache_accessor.open_ref(nid, 'friends.json', ref)
+            if page is None:
+                self.logger.warning('Page %s of user %s is gone, its '
+                                    'friends are left out' %
+                                    (ref.strip(), nid))
+                if not self.expand_refs:
+                    # the next crawl stores it again
+                    self.cache_accessor.forget_digest(nid, 'friends.json',
+                                                      (ref.split() or [''])[0])
+                continue
+            with closing(page) as fin:
+                self.read_friends(nid, fin)
+        return False
+
+    def flush_friends(self, nid, fids):
+        self.db.insert_many('friends', [(nid, fid, self.instance,
+                                         self.instance) for fid in fids])
+        del fids[:]
+
+    def store_friends_delta(self, nid, filenames):
+        """Write the friends a user added and removed since the last crawl,
+        return True if the rest needs a touch"""
+        snapshot = _Snapshot(self.cache_accessor, nid)
+        previous = snapshot.previous(self.instance)
+        pages = {}
+        known = True
+        for filename in filenames:
+            self.logger.debug('processing ' + filename)
+            fin = self.cache_accessor.open_record(filename)
+            if '.json.ref.' in os.path.basename(filename):
+                with closing(fin):
+                    ref = fin.read()
+                digest = (ref.split() or [''])[0]
+                if previous is not None and digest in previous:
+                    pages[digest] = previous[digest]
+                    continue
+                # not in the snapshot, read it where it was stored
+                fin = self.cache_accessor.open_ref(nid, 'friends.json', ref)
+                if fin is None:
+                    # the same as a page we do not have, the next crawl
+                    # stores it again
+                    if not snapshot.stale(self.instance):
+                        self.cache_accessor.forget_digest(
+                                nid, 'friends.json', digest)
+                    known = False
+                    continue
+            with closing(fin):
+                try:
+                    # one id at a time, the digest is of the whole page
+                    reader = _DigestReader(fin)
+                    ids = list(misc.iter_json_array(reader, 'ids'))
+                    pages[reader.hexdigest()] = ids
+                except Exception as e:
+                    self.logger.error(
+                            "Can't process friends info, error: " + str(e))
+                    known = False
+        snapshot.save(self.instance, previous, pages)
+        fids = set()
+        for ids in pages.values():
+            fids.update(ids)
+        if previous is None or not known:
+            # nothing to diff against, all we know goes in
+            self.flush_friends(nid, sorted(fids))
+            return not known
+        before = set()
+        for ids in previous.values():
+            before.update(ids)
+        self.flush_friends(nid, sorted(fids - before))
+        self.db.insert_many('unfollows', [(nid, fid, self.instance)
+                                          for fid in sorted(before - fids)])
+        return True
+
+class _DigestReader:
+    """Reads a file through, hashing what is read"""
+    def __init__(self, fin):
+        self.fin = fin
+        self.sha1 = hashlib.sha1()
+
+    def read(self, size=-1):
+        data = self.fin.read(size)
+        self.sha1.update(data)
+        return data
+
+    def hexdigest(self):
+        """Return the digest of the whole file, reading the rest of it"""
+        while self.read(65536):
+            pass
+        return self.sha1.hexdigest()
+
+
+class _Snapshot:
+    """The friend ids of a user by page digest as of the last two crawls
+    processed, in the user's watermark directory: friends.snapshot holds
+    the last one and friends.snapshot.base the one before, each the
+    instance on the first line and {digest: ids} on the second, so only
+    the generation diffed against is ever parsed.
+
+    Processing an instance again diffs against the same pages as the first
+    time, so resumed and repeated runs write the same rows.  The pages of
+    an instance only count once it is loaded: the delta against a crawl
+    that failed to load, or is still loading, would miss the changes it
+    carried, so the full list goes in instead.
+    """
+    def __init__(self, accessor, nid):
+        self.accessor = accessor
+        self.dir = accessor.get_watermark_dir(nid, create=True)
+        self.path = os.path.join(self.dir, 'friends.snapshot')
+        self.instance = None    # of the last snapshot
+        if os.path.exists(self.path):
+            with closing(open(self.path)) as fin:
+                self.instance = fin.readline().rstrip('\n') or None
+
+    def stale(self, instance):
+        """Return True if a later instance was processed already"""
+        return self.instance is not None and self.instance > instance
+
+    def previous(self, instance):
+        """Return {digest: ids} of the crawl before instance, or None"""
+        if self.instance is None or self.stale(instance):
+            return None
+        if self.instance == instance:
+            return self.pages(self.path + '.base')
+        if not self.accessor.instance_loaded(
+                misc.timefunctions.sqlTimeToInstance(self.instance)):
+            return None
+        return self.pages(self.path)
+
+    def pages(self, path):
+        """Return the {digest: ids} of a snapshot file, or None"""
+        if not os.path.exists(path):
+            return None
+        try:
+            with closing(open(path)) as fin:
+                fin.readline()
+                return json.loads(fin.readline())
+        except ValueError:
+            return None     # diff against nothing rather than garbage
+
+    def save(self, instance, previous, pages):
+        if self.stale(instance):
+            return
+        base = self.path + '.base'
+        if self.instance != instance:
+            if previous is not None:
+                # previous is the last snapshot, it becomes the base as is
+                os.rename(self.path, base)
+            elif os.path.exists(base):
+                os.remove(base)
+        # write aside and rename so a crash leaves the old snapshot
+        with closing(open(self.path + '.tmp', 'w')) as fout:
+            fout.write(instance + '\n')
+            json.dump(pages, fout)
+            fout.write('\n')
+        os.rename(self.path + '.tmp', self.path)
+
+
+def _process_shard(shard):
+    """Process a run of users in a worker process of the pool"""
+    (config, instance, cache_dir, dir_shard, users) = shard
+    logger = logging.getLogger('')
+    resume = os.path.exists(dir_shard)
+    if not resume:
+        os.makedirs(dir_shard)
+    processor = Processor(config, logger)
+    processor.instance = misc.timefunctions.instanceToSqlTime(instance)
+    processor.cache_accessor = misc.get_cache_accessor(cache_dir, logger,
+            config.get('dir_watermarks'))
+    processor.process_users(users, dir_shard, resume)
+    processor.cache_accessor.close()
+
+
+class _Checkpoint:
+    """Durable log of the users and files processed into a directory of
+    tables
+
+    The processor syncs the tables every process_checkpoint users, then
+    appends the users done since the last checkpoint and the sizes of the
+    tables to dir/checkpoint.  Resuming cuts the tables back to the sizes of
+    the last complete checkpoint, dropping the rows of users it does not
+    list, who are processed again.  Without resume the directory starts
+    with no tables.
+    """
+    def __init__(self, dir_out, resume=False):
+        self.dir_out = dir_out
+        self.path = os.path.join(dir_out, 'checkpoint')
+        self.done = {}          # nid -> files processed
+        self.pending = []       # (nid, files) since the last checkpoint
+        sizes = {}
+        if resume and os.path.exists(self.path):
+            sizes = self.load()
+        elif os.path.exists(self.path):
+            os.remove(self.path)
+        for table in _Checkpoint.tables(dir_out):
+            path = os.path.join(dir_out, table)
+            if table in sizes:
+                with closing(open(path, 'r+b')) as fout:
+                    fout.truncate(sizes[table])
+            else:
+                os.remove(path)
+
+    @staticmethod
+    def tables(dir_out):
+        return [name for name in os.listdir(dir_out)
+                if name.endswith('.tsv') or name.endswith('.tsv.gz')]
+
+    def load(self):
+        """Read the log, return the table sizes of the last checkpoint"""
+        sizes = {}
+        pending = []
+        length = 0              # of the log up to the last checkpoint
+        read = 0
+        with closing(open(self.path)) as fin:
+            for line in fin:
+                if not line.endswith('\n'):
+                    break       # torn by a crash
+                read += len(line)
+                fields = line.rstrip('\n').split('\t')
+                if fields[0] == 'user':
+                    pending.append((fields[1], fields[2:]))
+                elif fields[0] == 'checkpoint':
+                    for (nid, files) in pending:
+                        self.done.setdefault(nid, set()).update(files)
+                    pending = []
+                    sizes = json.loads(fields[1])
+                    length = read
+        # later users have rows past the sizes, forget them
+        with closing(open(self.path, 'r+b')) as fout:
+            fout.truncate(length)
+        return sizes
+
+    def todo(self, nid, files):
+        """Return the files of a user still to process"""
+        done = self.done.get(nid)
+        if not done or not files:
+            return files
+        return [filename for filename in files if filename not in done]
+
+    def add(self, nid, files):
+        self.pending.append((nid, files))
+
+    def commit(self):
+        """Log the pending users with the table sizes, durably"""
+        sizes = {}
+        for table in _Checkpoint.tables(self.dir_out):
+            sizes[table] = os.path.getsize(os.path.join(self.dir_out, table))
+        with closing(open(self.path, 'a')) as fout:
+            for (nid, files) in self.pending:
+                fout.write('\t'.join(['user', nid] + list(files)) + '\n')
+                self.done.setdefault(nid, set()).update(files)
+            fout.write('checkpoint\t%s\n' % json.dumps(sizes))
+            fout.flush()
+            os.fsync(fout.fileno())
+        self.pending = []
 
 
 def main():
+    parser = optparse.OptionParser(usage='%prog [options] '
+                                   'cache/2012.03.10.10.10.10')
+    parser.add_option('--resume', action='store_true',
+                      help='only process what earlier runs did not')
+    (opts, args) = parser.parse_args()
     # Get cache path from parameter
-    if len(sys.argv) < 2:
-        print('Usage:%s cache/2012.03.10.10.10.10' % sys.argv[0])
-        sys.exit(0)
-    if not os.path.exists(sys.argv[1]):
-        print('Usage:%s cache/2012.03.10.10.10.10' % sys.argv[0])
+    if len(args) < 1 or not os.path.exists(args[0]):
+        parser.print_usage()
         sys.exit(0)
-    cache_dir = sys.argv[1]
+    cache_dir = args[0].rstrip('/')
+    # The instance is the name of the cache directory if it is one
+    instance = os.path.basename(cache_dir)
+    try:
+        misc.timefunctions.instanceToSqlTime(instance)
+    except ValueError:
+        instance = misc.timefunctions.datestamp()
 
     # Load global configurations
     fp = open('config.json')
@@ -153,7 +592,7 @@ def main():
 
     # Instantiate a processor
     processor = Processor(config, logger)
-    processor.process(misc.timefunctions.datestamp(), cache_dir)
+    processor.process(instance, cache_dir, opts.resume)
 
 if __name__ == "__main__":
     main()
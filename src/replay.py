@@ -0,0 +1,329 @@
+#!/usr/bin/python2.6
+from __future__ import with_statement
+from __future__ import print_function
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import logging
+import optparse
+import multiprocessing
+from contextlib import closing
+
+import misc
+import loader
+import processor
+
+INSTANCE = re.compile(r'^\d{4}\.\d\d\.\d\d\.\d\d\.\d\d\.\d\d$')
+# Tables are merged in this order within an instance
+TABLES = ['friends', 'users', 'users_update', 'tweets', 'hashtags', 'urls',
+          'mentions']
+
+
+class Replay:
+    """Processes every crawl instance under dir_cache again and loads the
+    result at once, after a change to the processor or the schema
+
+    Instances are processed in a pool of replay_workers processes into
+    dir_replay/<instance>, and each splits its rows into replay_partitions
+    partitions by the leading id column, user id or tweet id.  Friends
+    pages stored as .ref records are read out of the instances that
+    stored them, so every instance yields whole friend lists and no
+    touches.  Partitions are then merged in parallel, reading the
+    instances oldest first so the latest value wins: the last users and
+    tweets rows, the last non empty users_update times, the first
+    date_added and last date_last of a friend.  The merged tables go
+    through one Loader.load, check compares their friends with the
+    database.  A replay that is interrupted picks up where it stopped
+    unless started fresh.
+    """
+    def __init__(self, config, logger):
+        self.config = config
+        self.logger = logger
+        self.dir_cache = self.config['dir_cache']
+        self.dir_replay = self.config.get('dir_replay', 'replay')
+        self.workers = self.config.get('replay_workers', 4)
+        self.partitions = self.config.get('replay_partitions', 16)
+
+    def instances(self, unloaded=False):
+        """Return the instances under dir_cache, oldest first, only the
+        loaded ones unless unloaded"""
+        instances = []
+        archived = 0
+        for name in sorted(os.listdir(self.dir_cache)):
+            path = os.path.join(self.dir_cache, name)
+            if not INSTANCE.match(name) or not os.path.isdir(path):
+                if INSTANCE.match(name.split('.tar.gz')[0]):
+                    archived += 1
+                continue
+            loaded = [filename for filename in os.listdir(path)
+                      if filename.startswith('seed[')]
+            if loaded or unloaded:
+                instances.append(name)
+        if archived:
+            self.logger.warning('Skipping %d compacted instances, extract '
+                                'them into %s to replay them' %
+                                (archived, self.dir_cache))
+        return instances
+
+    def replay(self, fresh=False, load=True, unloaded=False):
+        if fresh:
+            shutil.rmtree(self.dir_replay, True)
+        if not os.path.exists(self.dir_replay):
+            os.makedirs(self.dir_replay)
+        instances = self.instances(unloaded)
+        self.logger.info('Replaying %d instances with %d workers' %
+                         (len(instances), self.workers))
+        # one process per instance, the pool cannot nest another pool
+        config = dict(self.config)
+        config['process_workers'] = 1
+        config['process_compress'] = 0
+        # whole friend lists to merge, and the snapshots left alone
+        config['process_friends_delta'] = 0
+        config['process_expand_refs'] = 1
+        tasks = [(config, instance, os.path.join(self.dir_cache, instance),
+                  os.path.join(self.dir_replay, instance), self.partitions)
+                 for instance in instances]
+        pool = multiprocessing.Pool(self.workers)
+        try:
+            progress = _Progress(self.logger, 'processed', len(tasks))
+            for instance in pool.imap_unordered(_replay_instance, tasks):
+                progress.step(instance)
+            # merge the partitions
+            dir_merged = os.path.join(self.dir_replay, 'merged')
+            shutil.rmtree(dir_merged, True)
+            tasks = [(instances, self.dir_replay, part,
+                      os.path.join(dir_merged, 'part-%03d' % part))
+                     for part in range(self.partitions)]
+            progress = _Progress(self.logger, 'merged', len(tasks))
+            for part in pool.imap_unordered(_merge_partition, tasks):
+                progress.step('partition %d' % part)
+        finally:
+            pool.close()
+            pool.join()
+        for table in TABLES:
+            with closing(open(os.path.join(dir_merged, table + '.tsv'),
+                              'wb')) as fout:
+                for task in tasks:
+                    path = os.path.join(task[3], table + '.tsv')
+                    if os.path.exists(path):
+                        with closing(open(path, 'rb')) as fin:
+                            shutil.copyfileobj(fin, fout)
+        for task in tasks:
+            shutil.rmtree(task[3], True)
+        if load:
+            start = time.time()
+            self.logger.info('Loading ' + dir_merged)
+            if loader.create(self.config, self.logger).load(dir_merged):
+                self.logger.info('Loading COMPLETE in %s' %
+                                 _Progress.clock(time.time() - start))
+            else:
+                self.logger.error('Loading FAILED, load %s again with '
+                                  'loader.py' % dir_merged)
+        return dir_merged
+
+    def check(self, dir_merged):
+        """Compare the friends of dir_merged with the friends table of the
+        database, return the number of rows found on one side only"""
+        merged = set()
+        with closing(open(os.path.join(dir_merged, 'friends.tsv'))) as fin:
+            for line in fin:
+                merged.add(tuple(line.rstrip('\n').split('\t')))
+        db = misc.connect_db(self.config, self.logger)
+        db.execute('SELECT user_id, friend_id, date_added, date_last '
+                   'FROM friends')
+        live = set([tuple([str(value) for value in row])
+                    for row in db.cursor.fetchall()])
+        db.__del__()
+        for (side, rows) in (('replay', merged - live),
+                             ('database', live - merged)):
+            for row in sorted(rows)[:10]:
+                self.logger.error('Only in the %s: friends %s' %
+                                  (side, '\t'.join(row)))
+        differ = len(merged ^ live)
+        self.logger.info('Friends: %d replayed, %d in the database, %d '
+                         'differ' % (len(merged), len(live), differ))
+        return differ
+
+
+class _Progress:
+    """Logs how far a phase got and how long the rest should take"""
+    def __init__(self, logger, what, total):
+        self.logger = logger
+        self.what = what
+        self.total = total
+        self.done = 0
+        self.start = time.time()
+
+    @staticmethod
+    def clock(seconds):
+        return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60,
+                                 seconds % 60)
+
+    def step(self, name):
+        self.done += 1
+        elapsed = time.time() - self.start
+        left = elapsed / self.done * (self.total - self.done)
+        self.logger.info('%s %s, %d/%d %d%%, %s elapsed, %s left' %
+                         (self.what, name, self.done, self.total,
+                          100 * self.done / self.total,
+                          _Progress.clock(elapsed), _Progress.clock(left)))
+
+
+def _replay_instance(task):
+    """Process an instance in a worker of the pool and split its tables
+    into partitions"""
+    (config, instance, cache_dir, dir_instance, partitions) = task
+    logger = logging.getLogger('')
+    done = os.path.join(dir_instance, 'partitioned')
+    marker = '%d partitions\n' % partitions
+    if os.path.exists(done):
+        if open(done).read() == marker:
+            return instance     # by an earlier replay
+        shutil.rmtree(dir_instance)
+    if not os.path.exists(dir_instance):
+        os.makedirs(dir_instance)
+    processor.Processor(config, logger).process(instance, cache_dir,
+            resume=True, dir_processed=dir_instance)
+    for table in TABLES:
+        path = os.path.join(dir_instance, table + '.tsv')
+        if not os.path.exists(path):
+            continue
+        parts = {}
+        with closing(open(path, 'rb')) as fin:
+            for line in fin:
+                part = int(line[:line.index('\t')]) % partitions
+                if part not in parts:
+                    dir_part = os.path.join(dir_instance, 'part-%03d' % part)
+                    if not os.path.exists(dir_part):
+                        os.makedirs(dir_part)
+                    parts[part] = open(os.path.join(dir_part, table + '.tsv'),
+                                       'wb', 1024 * 1024)
+                parts[part].write(line)
+        for fout in parts.values():
+            fout.close()
+    with closing(open(done, 'w')) as fout:
+        fout.write(marker)
+    for name in os.listdir(dir_instance):
+        if not name.startswith('part-') and name != 'partitioned':
+            os.remove(os.path.join(dir_instance, name))
+    return instance
+
+
+def _merge_partition(task):
+    """Merge a partition of every instance, oldest first, the latest value
+    of a key wins"""
+    (instances, dir_replay, part, dir_out) = task
+    users = {}
+    tweets = {}
+    updates = {}        # user id -> [user id, info, tweet, friend times]
+    friends = {}        # user id -> {friend id: [date_added, date_last]}
+    entities = {'hashtags': set(), 'urls': set(), 'mentions': set()}
+    for instance in instances:
+        dir_part = os.path.join(dir_replay, instance, 'part-%03d' % part)
+        for table in TABLES:
+            path = os.path.join(dir_part, table + '.tsv')
+            if not os.path.exists(path):
+                continue
+            with closing(open(path, 'rb')) as fin:
+                for line in fin:
+                    if table in entities:
+                        entities[table].add(line)
+                        continue
+                    fields = line.rstrip('\n').split('\t')
+                    uid = fields[0]
+                    if table == 'users':
+                        users[uid] = line
+                    elif table == 'tweets':
+                        tweets[uid] = line
+                    elif table == 'users_update':
+                        update = updates.setdefault(uid, fields)
+                        for column in (1, 2, 3):
+                            if fields[column]:
+                                update[column] = fields[column]
+                    elif table == 'friends':
+                        user = friends.setdefault(uid, {})
+                        if fields[1] in user:
+                            user[fields[1]][1] = fields[3]
+                        else:
+                            user[fields[1]] = [fields[2], fields[3]]
+    os.makedirs(dir_out)
+
+    def write(table, lines):
+        with closing(open(os.path.join(dir_out, table + '.tsv'), 'wb',
+                          1024 * 1024)) as fout:
+            fout.writelines(lines)
+
+    def ids(table):
+        return sorted(table.keys(), key=int)
+
+    write('users', [users[uid] for uid in ids(users)])
+    write('tweets', [tweets[tid] for tid in ids(tweets)])
+    write('users_update', ['\t'.join(updates[uid]) + '\n'
+                           for uid in ids(updates)])
+    lines = []
+    for uid in ids(friends):
+        user = friends[uid]
+        for fid in ids(user):
+            lines.append('%s\t%s\t%s\t%s\n' % (uid, fid, user[fid][0],
+                                               user[fid][1]))
+    write('friends', lines)
+    for table in entities:
+        write(table, sorted(entities[table]))
+    return part
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]\n\nProcess every '
+            'crawl instance under dir_cache again and load the result')
+    parser.add_option('--workers', type='int',
+                      help='processes, replay_workers of config.json')
+    parser.add_option('--partitions', type='int',
+                      help='partitions merged apart, replay_partitions')
+    parser.add_option('--fresh', action='store_true',
+                      help='start over instead of going on with the last '
+                           'replay')
+    parser.add_option('--unloaded', action='store_true',
+                      help='also replay instances not loaded yet')
+    parser.add_option('--no-load', action='store_true',
+                      help='only merge, leave dir_replay/merged to load')
+    parser.add_option('--check', action='store_true',
+                      help='compare the merged friends with the database, '
+                           'with --no-load against the live load')
+    parser.add_option('--defer-indexes', choices=('disable', 'drop'),
+                      help='keep secondary indexes out of the way of the '
+                           'load, see loader_defer_indexes')
+    (opts, args) = parser.parse_args()
+
+    # Load global configurations
+    fp = open('config.json')
+    config = json.load(fp)
+    fp.close()
+    if opts.workers:
+        config['replay_workers'] = opts.workers
+    if opts.partitions:
+        config['replay_partitions'] = opts.partitions
+    if opts.defer_indexes:
+        config['loader_defer_indexes'] = opts.defer_indexes
+
+    # Setup logger
+    formatter = logging.Formatter(
+            '%(asctime)-6s: %(funcName)s(%(filename)s:%(lineno)d) - '
+            '%(levelname)s - %(message)s')
+    consoleLogger = logging.StreamHandler()
+    consoleLogger.setLevel(logging.INFO)
+    consoleLogger.setFormatter(formatter)
+    logging.getLogger('').addHandler(consoleLogger)
+    logger = logging.getLogger('')
+    logger.setLevel(logging.INFO)
+
+    replay = Replay(config, logger)
+    dir_merged = replay.replay(opts.fresh, not opts.no_load, opts.unloaded)
+    if opts.check and replay.check(dir_merged):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
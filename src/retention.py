@@ -0,0 +1,222 @@
+#!/usr/bin/python2.6
+from __future__ import with_statement
+from __future__ import print_function
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import logging
+import tarfile
+import optparse
+from contextlib import closing
+
+import leases
+
+MAINTAIN = '__maintain__'   # lease on maintaining dir_cache
+ARCHIVE = '.tar.gz'
+
+
+class Retention:
+    """Keeps dir_cache from growing without limit
+
+    Every crawl leaves an instance directory under dir_cache.  Once an
+    instance is loaded (load_instance copies its seed file into it, the last
+    thing it does) it is only history and the policies below apply, oldest
+    instance first:
+      cache_compact_days  compact instances older than this into a single
+                          <instance>.tar.gz archive
+      cache_retention_days  remove instances and archives older than this
+      cache_budget_mb     remove the oldest instances and archives until
+                          dir_cache fits in this many megabytes
+    A policy set to 0 is off.  Instances not loaded, still running or
+    failed to load, are never touched, archives are written aside and
+    renamed, and only one node maintains the cache at a time.  Sizes are
+    only measured for cache_budget_mb, once for a loaded instance since it
+    no longer changes.
+    """
+    INSTANCE = re.compile(r'^\d{4}\.\d\d\.\d\d\.\d\d\.\d\d\.\d\d$')
+
+    def __init__(self, config, logger):
+        self.config = config
+        self.logger = logger
+        self.dir_cache = self.config['dir_cache']
+        self.compact_days = self.config.get('cache_compact_days', 0)
+        self.retention_days = self.config.get('cache_retention_days', 0)
+        self.budget = int(self.config.get('cache_budget_mb', 0) * 1024 * 1024)
+        self.leases = leases.create(config, logger)
+        self.sizes = {}         # name -> bytes of the loaded instances
+
+    def enabled(self):
+        return bool(self.compact_days or self.retention_days or self.budget)
+
+    def instances(self, measure=None):
+        """Return [(name, path, start time, bytes, loaded)] of every instance
+        and archive, oldest first.  Bytes are 0 for a directory unless
+        measure, by default only with a budget"""
+        if measure is None:
+            measure = bool(self.budget)
+        instances = []
+        names = sorted(os.listdir(self.dir_cache))
+        for name in names:
+            path = os.path.join(self.dir_cache, name)
+            instance = name
+            if name.endswith(ARCHIVE):
+                instance = name[:-len(ARCHIVE)]
+            if not Retention.INSTANCE.match(instance):
+                continue    # partial archives and strangers
+            start = time.mktime(time.strptime(instance, '%Y.%m.%d.%H.%M.%S'))
+            if name in self.sizes:
+                (size, loaded) = (self.sizes[name], True)
+            elif os.path.isdir(path):
+                loaded = bool([filename for filename in os.listdir(path)
+                               if filename.startswith('seed[')])
+                size = 0
+                if measure:
+                    size = self.du(path)
+                    if loaded:
+                        self.sizes[name] = size
+            else:
+                size = os.path.getsize(path)
+                loaded = True
+            instances.append((name, path, start, size, loaded))
+        for name in list(self.sizes.keys()):
+            if name not in names:
+                del self.sizes[name]    # evicted, maybe by another node
+        return instances
+
+    def du(self, path):
+        """Return the bytes of the files under path"""
+        size = 0
+        for (dirpath, dirnames, filenames) in os.walk(path):
+            for filename in filenames:
+                try:
+                    size += os.path.getsize(os.path.join(dirpath, filename))
+                except OSError:
+                    pass
+        return size
+
+    def plan(self, now=None, measure=None):
+        """Return [(action, name, bytes, reason)] the policies call for,
+        action is compact or remove"""
+        if now is None:
+            now = time.time()
+        actions = []
+        instances = self.instances(measure)
+        total = sum([size for (name, path, start, size, loaded) in instances])
+        for (name, path, start, size, loaded) in instances:
+            if not loaded:
+                continue
+            age = (now - start) / 86400
+            if self.retention_days and age > self.retention_days:
+                reason = 'older than %s days' % self.retention_days
+            elif self.budget and total > self.budget:
+                reason = 'cache over %.1f MB' % (self.budget / 1024.0 / 1024)
+            else:
+                if (self.compact_days and age > self.compact_days and
+                        not name.endswith(ARCHIVE)):
+                    actions.append(('compact', name, size,
+                                    'older than %s days' % self.compact_days))
+                continue
+            actions.append(('remove', name, size, reason))
+            total -= size
+        return actions
+
+    def report(self, actions):
+        lines = []
+        for (action, name, size, reason) in actions:
+            lines.append('%-8s %-28s %10.1f MB  %s' %
+                         (action, name, size / 1024.0 / 1024, reason))
+        removed = sum([size for (action, name, size, reason) in actions
+                       if action == 'remove'])
+        lines.append('%d actions, %.1f MB removed' %
+                     (len(actions), removed / 1024.0 / 1024))
+        return '\n'.join(lines)
+
+    def maintain(self, dry_run=False, measure=None):
+        """Apply the policies, return the actions taken or, with dry_run,
+        the ones that would be"""
+        if not self.enabled():
+            return []
+        if not dry_run and not self.leases.claim(MAINTAIN):
+            self.logger.info('Another node is maintaining the cache')
+            return []
+        try:
+            actions = self.plan(measure=measure)
+            if dry_run:
+                return actions
+            for (action, name, size, reason) in actions:
+                path = os.path.join(self.dir_cache, name)
+                try:
+                    if action == 'compact':
+                        self.compact(path)
+                    else:
+                        self.remove(path)
+                    self.sizes.pop(name, None)
+                    self.logger.info('Cache %s %s: %s' %
+                                     (action, name, reason))
+                except Exception as e:
+                    self.logger.error('Failed to %s %s: %s' %
+                                      (action, name, e))
+            return actions
+        finally:
+            if not dry_run:
+                self.leases.release(MAINTAIN)
+
+    def compact(self, path):
+        archive = path + ARCHIVE
+        # write aside and rename so an archive is always complete
+        with closing(tarfile.open(archive + '.tmp', 'w:gz')) as tar:
+            tar.add(path, os.path.basename(path))
+        os.rename(archive + '.tmp', archive)
+        shutil.rmtree(path)
+
+    def remove(self, path):
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]\n\nCompact and '
+            'evict loaded crawl instances under dir_cache')
+    parser.add_option('--dry-run', action='store_true',
+                      help='only report what would be done')
+    parser.add_option('--compact-days', type='float')
+    parser.add_option('--retention-days', type='float')
+    parser.add_option('--budget-mb', type='float')
+    (opts, args) = parser.parse_args()
+
+    # Load global configurations
+    fp = open('config.json')
+    config = json.load(fp)
+    fp.close()
+    for (option, key) in (('compact_days', 'cache_compact_days'),
+                          ('retention_days', 'cache_retention_days'),
+                          ('budget_mb', 'cache_budget_mb')):
+        if getattr(opts, option) is not None:
+            config[key] = getattr(opts, option)
+
+    # Setup logger
+    formatter = logging.Formatter(
+            '%(asctime)-6s: %(funcName)s(%(filename)s:%(lineno)d) - '
+            '%(levelname)s - %(message)s')
+    consoleLogger = logging.StreamHandler()
+    consoleLogger.setLevel(logging.DEBUG)
+    consoleLogger.setFormatter(formatter)
+    logging.getLogger('').addHandler(consoleLogger)
+    logger = logging.getLogger('')
+    logger.setLevel(logging.DEBUG)
+
+    retention = Retention(config, logger)
+    if not retention.enabled():
+        print('No retention policy set, see cache_compact_days, '
+              'cache_retention_days and cache_budget_mb')
+        sys.exit(0)
+    print(retention.report(retention.maintain(opts.dry_run, measure=True)))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,15 +2,21 @@
 import os
 import shutil
 import sys
+import time
 import signal
 import json
+import Queue
 import logging
 import logging.handlers
+import threading
+import traceback
 
 import crawler
 import processor
 import loader
 import generator
+import leases
+import retention
 import misc
 
 class Twaler:
@@ -56,7 +62,9 @@ class Twaler:
         self.generator = generator.Generator(self.config, self.logger)
         self.crawler = crawler.Crawler(self.config, self.logger)
         self.processor = processor.Processor(self.config, self.logger)
-        self.loader = loader.Loader(self.config, self.logger)
+        self.loader = loader.create(self.config, self.logger)
+        self.leases = leases.create(self.config, self.logger)
+        self.retention = retention.Retention(self.config, self.logger)
 
     def twale(self):
         self.logger.debug('twaler started')
@@ -78,16 +86,11 @@ class Twaler:
     def watchlist(self):
         '''Watch a fixed list of user_id'''
         # Clean up database first
-        db = misc.mysql_db(self.config['db_server'],
-                           self.config['db_username'],
-                           self.config['db_password'],
-                           self.config['db_database'], self.logger)
+        db = misc.connect_db(self.config, self.logger)
         stmt = 'DELETE FROM target_users'
         db.execute(stmt)
         # TODO still have problem
-        stmt = ('LOAD DATA LOCAL INFILE "seed.lst" INTO TABLE target_users '
-                'FIELDS TERMINATED BY \"\\t\" LINES TERMINATED BY \"\\n\"')
-        db.execute(stmt)
+        db.load('target_users', 'seed.lst')
         # Get that list first
         self.crawl('seed.lst')
         # Get that list's friend second
@@ -102,49 +105,225 @@ class Twaler:
         self.twalerloop()
 
     def twalerloop(self):
+        if self.config.get('pipeline', 0):
+            self.pipelineloop()
+            return
         # Loop forever unless interrupted by user
         while True:
             # Check for seeds
             seeds = os.listdir(self.config['dir_seeds'])
             # Generate more if needed
             if not seeds:
+                self.generate()
+                seeds = os.listdir(self.config['dir_seeds'])
+            claimed = False
+            for seed in seeds:  # N.B. seed is a filename with seeds
+                if not self.claim(seed):
+                    continue    # another node is on it
+                claimed = True
+                try:
+                    self.crawl(seed)
+                finally:
+                    self.leases.release(seed)
+            if seeds and not claimed:
+                time.sleep(self.config.get('lease_poll', 10))
+
+    def claim(self, seed):
+        '''Take the lease on a seed file that is still to be crawled'''
+        if not self.leases.claim(seed):
+            return False
+        if not os.path.exists(os.path.join(self.config['dir_seeds'], seed)):
+            # finished by another node since we listed the directory
+            self.leases.release(seed)
+            return False
+        return True
+
+    def generate(self):
+        '''Generate new seed files, only one node at a time does it'''
+        if not self.leases.claim(leases.GENERATE):
+            time.sleep(self.config.get('lease_poll', 10))
+            return
+        try:
+            if not os.listdir(self.config['dir_seeds']):
                 self.logger.info("Start to generate new seeds")
                 self.generator.generate()
                 self.logger.info('Generate seeds COMPLETE')
-                seeds = os.listdir(self.config['dir_seeds'])
-            for seed in seeds:  # N.B. seed is a filename with seeds
-                self.crawl(seed)
+        finally:
+            self.leases.release(leases.GENERATE)
+
+    def pipelineloop(self):
+        '''Like twalerloop, but crawl, process and load run as concurrent
+        stages over successive instances, handing them over through queues
+        of pipeline_queue_size, so crawling seed file N+1 overlaps
+        processing N and loading N-1'''
+        size = self.config.get('pipeline_queue_size', 1)
+        to_crawl = Queue.Queue(size)
+        to_process = Queue.Queue(size)
+        to_load = Queue.Queue(size)
+        self.inflight = set()       # seed files somewhere in the pipeline
+        self.inflight_cond = threading.Condition()
+        self.stages = [
+                _PipelineStage('crawl', self.crawl_instance, to_crawl,
+                               to_process, self.retire, self.logger),
+                _PipelineStage('process', self.process_instance, to_process,
+                               to_load, self.retire, self.logger),
+                _PipelineStage('load', self.load_instance, to_load, None,
+                               self.retire, self.logger)]
+        for stage in self.stages:
+            stage.start()
+        # Feed the pipeline forever unless interrupted by user
+        while True:
+            seeds = [seed for seed in os.listdir(self.config['dir_seeds'])
+                     if seed not in self.inflight]
+            if not seeds:
+                # seeds come from loaded data, let the pipeline drain first
+                self.inflight_cond.acquire()
+                while self.inflight:
+                    self.inflight_cond.wait()
+                self.inflight_cond.release()
+                if not os.listdir(self.config['dir_seeds']):
+                    self.generate()
+                continue
+            claimed = False
+            for seed in seeds:
+                if not self.claim(seed):
+                    continue        # another node is on it
+                claimed = True
+                self.inflight_cond.acquire()
+                self.inflight.add(seed)
+                self.inflight_cond.release()
+                to_crawl.put(seed)  # blocks while the crawl stage is busy
+            if not claimed:
+                time.sleep(self.config.get('lease_poll', 10))
+
+    def retire(self, seed, failed=False):
+        '''Called when a seed file leaves the pipeline'''
+        if failed:
+            # put it aside instead of crawling it again and again
+            self.logger.error('Giving up on seed file %s' % seed)
+            seedfile = os.path.join(self.config['dir_seeds'], seed)
+            if os.path.exists(seedfile):
+                shutil.move(seedfile,
+                            os.path.join(self.config['dir_seedsdone'], seed))
+        self.leases.release(seed)
+        self.inflight_cond.acquire()
+        self.inflight.discard(seed)
+        self.inflight_cond.notifyAll()
+        self.inflight_cond.release()
+        report = ', '.join([stage.report() for stage in self.stages])
+        slowest = max(self.stages, key=lambda stage: stage.busy)
+        self.logger.info('Pipeline: %s; %s is the bottleneck' %
+                         (report, slowest.name))
 
     def crawl(self, seed):
         '''Read seed file, download, process and load to database
         A time stamp universally identified the crawling instance'''
+        instance = self.crawl_instance(seed)
+        instance = self.process_instance(instance)
+        self.load_instance(instance)
+
+    def crawl_instance(self, seed):
+        '''Download the seeds of a seed file into a new cache instance'''
         timestamp = misc.timefunctions.datestamp()
+        cache_dir = os.path.join(self.config['dir_cache'], timestamp)
+        while os.path.exists(cache_dir):
+            # instances are told apart by the second they started at
+            time.sleep(1)
+            timestamp = misc.timefunctions.datestamp()
+            cache_dir = os.path.join(self.config['dir_cache'], timestamp)
         self.logger.info('Crawling file %s as %s' % (seed, timestamp))
 
-        cache_dir = os.path.join(self.config['dir_cache'], timestamp)
         seedfile = os.path.join(self.config['dir_seeds'], seed)
-        processed_dir = os.path.join(cache_dir, "processed_crawl")
 
         # Crawl
         self.crawler.crawl(seedfile, cache_dir)
+        return (seed, timestamp)
+
+    def process_instance(self, instance):
+        (seed, timestamp) = instance
+        cache_dir = os.path.join(self.config['dir_cache'], timestamp)
 
         # Process
         self.logger.info("Processing instance " + timestamp)
         self.processor.process(timestamp, cache_dir)
         self.logger.info("Processing instance %s COMPLETE" % timestamp)
+        return instance
+
+    def load_instance(self, instance):
+        (seed, timestamp) = instance
+        cache_dir = os.path.join(self.config['dir_cache'], timestamp)
+        seedfile = os.path.join(self.config['dir_seeds'], seed)
+        processed_dir = os.path.join(cache_dir, "processed_crawl")
 
         # Load
         self.logger.info("Loading instance " + timestamp)
-        self.loader.load(processed_dir)
+        seeddonepath = os.path.join(self.config['dir_seedsdone'], seed)
+        if not self.loader.load(processed_dir):
+            # no seed marker, the instance counts as not loaded: retention
+            # keeps it and the next crawls do not refer to its pages
+            self.logger.error("Loading instance %s FAILED, load %s again "
+                              "with loader.py" % (timestamp, processed_dir))
+            shutil.move(seedfile, seeddonepath)
+            return None
         self.logger.info("Loading instance %s COMPLETE" % timestamp)
 
-        # Move seedfile out of seed directory
+        # Mark the instance loaded, move seedfile out of seed directory
         cachepath = os.path.join(self.config['dir_cache'], timestamp,
                                  "seed["+seed+"].txt")
-        seeddonepath = os.path.join(self.config['dir_seedsdone'], seed)
         shutil.copy(seedfile, cachepath)
         shutil.move(seedfile, seeddonepath)
 
+        # Make room for the next instances
+        self.retention.maintain()
+        return instance
+
+
+class _PipelineStage(threading.Thread):
+    """One stage of the pipeline, runs work on every item of its inbox
+    and hands the result to the outbox, keeping its own throughput"""
+    def __init__(self, name, work, inbox, outbox, done, logger):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.name = name
+        self.work = work
+        self.inbox = inbox
+        self.outbox = outbox
+        self.logger = logger
+        self.done = done
+        self.started = time.time()
+        self.busy = 0.0         # seconds spent working
+        self.count = 0          # instances done
+
+    def run(self):
+        while True:
+            item = self.inbox.get()
+            start = time.time()
+            try:
+                result = self.work(item)
+            except Exception as e:
+                traceback.print_exc()
+                self.logger.error('%s stage failed on %s: %s' %
+                                  (self.name, item, e))
+                result = None
+            self.busy += time.time() - start
+            self.count += 1
+            self.logger.info('%s stage: %s in %.1f s' %
+                             (self.name, item, time.time() - start))
+            if result is None or self.outbox is None:
+                # finished or dropped
+                seed = item
+                if isinstance(item, tuple):
+                    seed = item[0]
+                self.done(seed, result is None)
+            else:
+                self.outbox.put(result)     # blocks while next stage is busy
+
+    def report(self):
+        elapsed = max(time.time() - self.started, 1)
+        return ('%s %d instances %.2f/min busy %d%%' %
+                (self.name, self.count, self.count * 60.0 / elapsed,
+                 100 * self.busy / elapsed))
+
 
 if __name__ == '__main__':
     t = Twaler()